@@ -0,0 +1,108 @@
+"""
+Measures the per-message cost of Plugin.publish through to basic_publish.
+
+The RabbitMQ connection is replaced with an in-process fake, so the results only include
+the work done by pywaggle and pika's message encoding is not included.
+
+Usage: PYTHONPATH=src python3 benchmarks/publish.py [-n COUNT]
+"""
+
+import argparse
+import time
+from threading import Event
+
+import pika
+
+from waggle.plugin import Plugin, PluginConfig
+
+
+class FakeChannel:
+    def __init__(self, count, done):
+        self.count = count
+        self.done = done
+        self.published = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        pass
+
+    def tx_select(self):
+        pass
+
+    def tx_commit(self):
+        pass
+
+    def basic_publish(self, exchange, routing_key, body, properties=None):
+        self.published += 1
+        if self.published == self.count:
+            self.done.set()
+
+
+class FakeConnection:
+    channel_args = None
+
+    def __init__(self, params):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        pass
+
+    def channel(self):
+        return FakeChannel(*self.channel_args)
+
+    def process_data_events(self, time_limit=0):
+        pass
+
+
+def run(count, batch_size, chunk_size):
+    done = Event()
+    FakeConnection.channel_args = (count, done)
+    config = PluginConfig(
+        username="plugin",
+        password="plugin",
+        host="localhost",
+        port=5672,
+        app_id="benchmark",
+        publish_batch_size=batch_size,
+    )
+    with Plugin(config) as plugin:
+        start = time.perf_counter()
+        if chunk_size == 0:
+            for i in range(count):
+                plugin.publish("bench.value", i, timestamp=1649694687904754000 + i)
+        else:
+            for i in range(0, count, chunk_size):
+                plugin.publish_many(
+                    [
+                        ("bench.value", j, None, 1649694687904754000 + j)
+                        for j in range(i, min(i + chunk_size, count))
+                    ]
+                )
+        done.wait()
+        elapsed = time.perf_counter() - start
+    return elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-n", "--count", type=int, default=100000)
+    args = parser.parse_args()
+
+    pika.BlockingConnection = FakeConnection
+
+    for batch_size, chunk_size in [(0, 0), (100, 0), (0, 100), (100, 100)]:
+        elapsed = run(args.count, batch_size, chunk_size)
+        print(
+            f"batch_size={batch_size:<4d} publish_many_size={chunk_size:<4d} "
+            f"{args.count} messages in {elapsed:.3f}s "
+            f"{1e6 * elapsed / args.count:.2f}us/message {args.count / elapsed:.0f} messages/s"
+        )
+
+
+if __name__ == "__main__":
+    main()
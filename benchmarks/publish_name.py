@@ -0,0 +1,65 @@
+"""
+Measures the cost of publish name validation and its share of the Plugin.publish profile.
+
+Usage: PYTHONPATH=src python3 benchmarks/publish_name.py [-n COUNT]
+"""
+
+import argparse
+import cProfile
+import pstats
+import re
+import timeit
+
+import pika
+
+from publish import FakeConnection, run
+from waggle.plugin.plugin import raise_for_invalid_publish_name, valid_publish_names
+
+publish_name_part_pattern = re.compile("^[a-z0-9_]+$")
+
+
+def raise_for_invalid_publish_name_uncached(s: str):
+    # previous implementation which validated every part of every name
+    if not isinstance(s, str):
+        raise TypeError(f"publish name must be a string: {s!r}")
+    if len(s) > 128:
+        raise ValueError(f"publish must be at most 128 characters: {s!r}")
+    if s == "upload":
+        raise ValueError(f"name {s!r} is reserved for system use only")
+    parts = s.split(".")
+    for p in parts:
+        if not publish_name_part_pattern.match(p):
+            raise ValueError(
+                f"publish name invalid: {s!r} part: {p!r} (names must consist of [a-z0-9_] and may be joined by .)"
+            )
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-n", "--count", type=int, default=100000)
+    args = parser.parse_args()
+
+    name = "vision.object.count.car"
+
+    for label, func in [
+        ("uncached", raise_for_invalid_publish_name_uncached),
+        ("cached", raise_for_invalid_publish_name),
+    ]:
+        elapsed = timeit.timeit(lambda: func(name), number=args.count)
+        print(f"{label:<8s} {1e9 * elapsed / args.count:.0f}ns/name")
+
+    pika.BlockingConnection = FakeConnection
+    valid_publish_names.clear()
+    profile = cProfile.Profile()
+    profile.runcall(run, args.count, 0, 0)
+    stats = pstats.Stats(profile)
+    total = stats.total_tt
+    for (_, _, func), (_, _, tottime, cumtime, _) in stats.stats.items():
+        if func == "raise_for_invalid_publish_name":
+            print(
+                f"raise_for_invalid_publish_name {100 * cumtime / total:.1f}% of publish profile"
+            )
+
+
+if __name__ == "__main__":
+    main()
@@ -1,4 +1,5 @@
 from .config import PluginConfig
 from .plugin import Plugin
+from .asyncplugin import AsyncPlugin
 from .uploader import Uploader
 from .time import get_timestamp
@@ -0,0 +1,271 @@
+import asyncio
+import logging
+import wagglemsg
+
+from collections import deque
+from functools import partial
+from os import getenv
+from pathlib import Path
+
+from .plugin import (
+    FilesystemPublisher,
+    get_default_plugin_config,
+    get_default_plugin_uploader,
+    raise_for_invalid_publish_name,
+    raise_for_invalid_publish_args,
+)
+from .rabbitmq import PublishData
+from .time import get_timestamp, timeit_perf_counter, timeit_perf_counter_duration
+
+logger = logging.getLogger(__name__)
+
+
+class AsyncPlugin:
+    """
+    AsyncPlugin provides the same methods as Plugin for plugins built on asyncio.
+
+    Messages are published and consumed by tasks running on the event loop over a single
+    connection, so publish and get never block the loop. This requires the aio-pika module which
+    can be installed using the async extras flag.
+
+    Examples
+    --------
+
+    ```python
+    from waggle.plugin import AsyncPlugin
+
+    async def main():
+        async with AsyncPlugin() as plugin:
+            await plugin.publish("test_value", 99)
+
+            async for msg in plugin.subscribe("env.temperature"):
+                print(msg)
+    ```
+    """
+
+    def __init__(
+        self, config=None, uploader=None, file_publisher: FilesystemPublisher = None
+    ):
+        self.config = config or get_default_plugin_config()
+        self.uploader = uploader or get_default_plugin_uploader()
+        self.send = None
+        self.recv = None
+        self.tasks = []
+        self.connection = None
+        self.connected = None
+        self.stopping = False
+
+        self.file_publisher = file_publisher
+
+        if self.file_publisher is None and getenv("PYWAGGLE_LOG_DIR") is not None:
+            self.file_publisher = FilesystemPublisher(getenv("PYWAGGLE_LOG_DIR"))
+
+    async def __aenter__(self):
+        # NOTE aio_pika is an optional dependency, so we only import it when it's used.
+        import aio_pika
+
+        self.aio_pika = aio_pika
+        self.send = asyncio.Queue()
+        self.recv = asyncio.Queue()
+        self.connected = asyncio.Event()
+        self.stopping = False
+        self.connect_task = asyncio.ensure_future(self.__connect())
+        self.publisher_task = asyncio.ensure_future(self.__publish_messages())
+        self.tasks = [self.connect_task, self.publisher_task]
+        return self
+
+    async def __aexit__(self, exc_type, exc_value, exc_traceback):
+        self.stopping = True
+
+        if self.file_publisher is not None:
+            self.file_publisher.close()
+
+        # attempt to flush any remaining messages if we are connected
+        if self.connected.is_set():
+            await self.send.put(None)
+            await asyncio.gather(self.publisher_task, return_exceptions=True)
+
+        for task in self.tasks:
+            task.cancel()
+        await asyncio.gather(*self.tasks, return_exceptions=True)
+        self.tasks.clear()
+
+        if self.connection is not None:
+            await self.connection.close()
+            self.connection = None
+
+    async def __connect(self):
+        logger.debug("async plugin connecting to rabbitmq...")
+        while True:
+            try:
+                self.connection = await self.aio_pika.connect_robust(
+                    host=self.config.host,
+                    port=self.config.port,
+                    login=self.config.username,
+                    password=self.config.password,
+                )
+                break
+            except Exception:
+                if logger.isEnabledFor(logging.DEBUG):
+                    logger.exception("async plugin connect exception")
+                await asyncio.sleep(1)
+        logger.debug("async plugin connected to rabbitmq.")
+        self.connected.set()
+
+    async def __publish_messages(self):
+        await self.connected.wait()
+        channel = await self.connection.channel()
+        exchange = await channel.get_exchange("to-validator", ensure=False)
+        properties = {
+            "delivery_mode": self.aio_pika.DeliveryMode.PERSISTENT,
+            "user_id": self.config.username,
+        }
+        # NOTE app_id is used by data service to validate and tag additional metadata provided by k3s scheduler.
+        if self.config.app_id != "":
+            properties["app_id"] = self.config.app_id
+
+        # NOTE messages are only removed from pending once published, so they are retried in
+        # order while the robust connection reconnects.
+        pending = deque()
+        while True:
+            if len(pending) == 0:
+                item = await self.send.get()
+                if item is None:
+                    return
+                pending.append(item)
+            try:
+                item = pending[0]
+                await exchange.publish(
+                    self.aio_pika.Message(item.body.encode(), **properties),
+                    routing_key=item.scope,
+                )
+                pending.popleft()
+            except Exception:
+                if self.stopping:
+                    return
+                if logger.isEnabledFor(logging.DEBUG):
+                    logger.exception(
+                        "publish to rabbitmq failed. will retry message..."
+                    )
+                await asyncio.sleep(1)
+
+    async def __consume_messages(self, topics):
+        await self.connected.wait()
+        channel = await self.connection.channel()
+        queue = await channel.declare_queue(exclusive=True)
+        for topic in topics:
+            await queue.bind("data.topic", topic)
+            logger.debug("async plugin binding queue %s to topic %s", queue, topic)
+        await queue.consume(self.__process_message, no_ack=True)
+
+    async def __process_message(self, message):
+        try:
+            msg = wagglemsg.load(message.body)
+        except TypeError:
+            logger.debug("unsupported message type: %s", message)
+            return
+        self.recv.put_nowait(msg)
+
+    def subscribe(self, *topics):
+        """
+        subscribe starts receiving messages for the provided topics. Received messages can be read
+        using get or by iterating over the returned async iterator.
+        """
+        if len(self.tasks) == 0:
+            raise RuntimeError(
+                "AsyncPlugin can only be used inside an async with block!"
+            )
+        self.tasks.append(asyncio.ensure_future(self.__consume_messages(topics)))
+        return self.__iter_messages()
+
+    async def __iter_messages(self):
+        while True:
+            yield await self.get()
+
+    async def get(self, timeout=None):
+        try:
+            return self.recv.get_nowait()
+        except asyncio.QueueEmpty:
+            pass
+        try:
+            return await asyncio.wait_for(self.recv.get(), timeout)
+        except asyncio.TimeoutError:
+            pass
+        raise TimeoutError("plugin get timed out")
+
+    async def publish(
+        self, name, value, meta={}, timestamp=None, scope="all", timeout=None
+    ):
+        if len(self.tasks) == 0:
+            raise RuntimeError(
+                "AsyncPlugin can only be used inside an async with block!"
+            )
+        # get timestamp before doing other work
+        timestamp = timestamp or get_timestamp()
+        raise_for_invalid_publish_name(name)
+        await self.__publish(name, value, meta, timestamp, scope, timeout)
+
+    async def __publish(self, name, value, meta, timestamp, scope="all", timeout=None):
+        raise_for_invalid_publish_args(value, meta, timestamp)
+        msg = wagglemsg.Message(name=name, value=value, timestamp=timestamp, meta=meta)
+
+        # hack to use file publisher for everything except uploads
+        if self.file_publisher is not None and name != "upload":
+            self.file_publisher.publish(msg)
+
+        logger.debug("adding message to outgoing queue: %s", msg)
+        await asyncio.wait_for(
+            self.send.put(PublishData(scope, wagglemsg.dump(msg))), timeout
+        )
+
+    async def upload_file(self, path, meta={}, timestamp=None, keep=False):
+        # get timestamp before doing other work
+        timestamp = timestamp or get_timestamp()
+        loop = asyncio.get_event_loop()
+
+        if self.file_publisher is not None:
+            await loop.run_in_executor(
+                None,
+                partial(
+                    self.file_publisher.upload_file,
+                    path,
+                    meta=meta,
+                    timestamp=timestamp,
+                ),
+            )
+
+        if self.uploader is not None:
+            meta = meta.copy()
+            meta["filename"] = Path(path).name
+            # NOTE staging copies the file, so we run it in an executor to keep the loop free.
+            upload_path = await loop.run_in_executor(
+                None,
+                partial(
+                    self.uploader.upload_file,
+                    path=path,
+                    meta=meta,
+                    timestamp=timestamp,
+                    keep=keep,
+                ),
+            )
+            await self.__publish("upload", upload_path.name, meta, timestamp)
+
+    def timeit(self, name):
+        return AsyncTimeit(self, name)
+
+
+# NOTE contextlib.asynccontextmanager requires python 3.7, so timeit uses an explicit class.
+class AsyncTimeit:
+    def __init__(self, plugin: AsyncPlugin, name):
+        self.plugin = plugin
+        self.name = name
+
+    async def __aenter__(self):
+        logger.debug("starting timeit block %s", self.name)
+        self.start = timeit_perf_counter()
+
+    async def __aexit__(self, exc_type, exc_value, exc_traceback):
+        finish = timeit_perf_counter()
+        duration = timeit_perf_counter_duration(self.start, finish)
+        await self.plugin.publish(self.name, duration)
+        logger.debug("finished timeit block %s", self.name)
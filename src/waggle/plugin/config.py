@@ -12,3 +12,35 @@ class PluginConfig(NamedTuple):
     host: str
     port: int
     app_id: str
+
+    # NOTE publish_batch_size enables batched publishing when set above zero. the publisher
+    # drains up to publish_batch_size messages or waits up to publish_batch_timeout seconds
+    # and then commits the whole batch with a single broker acknowledgement.
+    publish_batch_size: int = 0
+    publish_batch_timeout: float = 0.05
+
+    # NOTE messages taken by the publisher but not yet acknowledged are kept in a bounded retry
+    # buffer and replayed in order after reconnecting. publish_retry_overflow may be one of
+    # "block", "drop_oldest" or "spill". spill writes overflow to files in publish_spill_dir.
+    publish_retry_buffer_size: int = 10000
+    publish_retry_overflow: str = "block"
+    publish_spill_dir: str = ""
+
+    # NOTE publish_outbox_dir enables a persistent outbox. messages are written to segment files
+    # in this directory before being published and are removed once acknowledged, so pending
+    # messages survive broker outages and restarts.
+    publish_outbox_dir: str = ""
+    publish_outbox_segment_size: int = 16 * 1024 * 1024
+
+    # NOTE send_queue_size bounds the number of items waiting in Plugin.send. zero means unbounded.
+    # send_queue_policy may be one of "block", "drop_newest", "drop_oldest" or "sample" and
+    # decides what publish does when the queue is full. each publish_many call is one item.
+    send_queue_size: int = 0
+    send_queue_policy: str = "block"
+    send_queue_sample_interval: int = 10
+
+    # NOTE upload_workers enables uploading files on a pool of background threads. upload_file
+    # then returns a future and only blocks while pending uploads exceed upload_max_pending_bytes.
+    # zero means uploads are done synchronously by the caller.
+    upload_workers: int = 0
+    upload_max_pending_bytes: int = 256 * 1024 * 1024
@@ -0,0 +1,181 @@
+import json
+import logging
+import os
+import struct
+import zlib
+from pathlib import Path
+
+logger = logging.getLogger(__name__)
+
+
+class Outbox:
+    """
+    Outbox is an append-only log of byte records stored as rotated segment files in a directory.
+
+    Records are read back in the order they were appended using peek and are removed using ack.
+    Segments are deleted once all of their records have been acknowledged and the position of the
+    oldest unacknowledged record is kept in a cursor file, so an Outbox reopened from the same
+    directory after a restart resumes with every record which was not acknowledged.
+
+    When sync is set, extend writes all of its records and then issues a single fsync, so the cost
+    of fsync is shared by every record written together.
+    """
+
+    record_header = struct.Struct(">II")
+
+    def __init__(self, root, segment_size=16 * 1024 * 1024, sync=True):
+        self.root = Path(root)
+        self.root.mkdir(parents=True, exist_ok=True)
+        self.segment_size = segment_size
+        self.sync = sync
+        self.cursor_path = Path(self.root, "cursor")
+        self.count = 0
+        self.ack_segment, self.ack_offset = self.__read_cursor()
+        self.segments = self.__recover_segments()
+        self.writer = None
+        self.__open_writer()
+
+    def __len__(self):
+        return self.count
+
+    def append(self, data: bytes):
+        self.extend([data])
+
+    def extend(self, records):
+        for data in records:
+            if self.writer.tell() >= self.segment_size:
+                self.__rotate_writer()
+            self.writer.write(self.record_header.pack(len(data), zlib.crc32(data)))
+            self.writer.write(data)
+            self.count += 1
+        self.writer.flush()
+        if self.sync:
+            os.fsync(self.writer.fileno())
+
+    def peek(self, n: int) -> list:
+        records = []
+        for _, _, data in self.__scan(n):
+            records.append(data)
+        return records
+
+    def ack(self, n: int):
+        if n > self.count:
+            raise ValueError("cannot ack more records than are in outbox")
+        for segment, offset, _ in self.__scan(n):
+            self.ack_segment, self.ack_offset = segment, offset
+        self.count -= n
+
+        if self.count == 0:
+            # everything has been confirmed, so we can drop all segments and start over.
+            self.writer.close()
+            for segment in self.segments:
+                self.__segment_path(segment).unlink()
+            self.segments = [self.segments[-1] + 1]
+            self.ack_segment, self.ack_offset = self.segments[0], 0
+            self.__open_writer()
+        else:
+            while self.segments[0] < self.ack_segment:
+                self.__segment_path(self.segments.pop(0)).unlink()
+
+        self.__write_cursor()
+
+    def close(self):
+        self.writer.close()
+
+    def __scan(self, n):
+        # yields the segment, end offset and data of up to n records following the ack cursor.
+        self.writer.flush()
+        found = 0
+        for segment in self.segments:
+            if found >= n:
+                return
+            offset = self.ack_offset if segment == self.ack_segment else 0
+            with self.__segment_path(segment).open("rb") as f:
+                f.seek(offset)
+                while found < n:
+                    header = f.read(self.record_header.size)
+                    if len(header) < self.record_header.size:
+                        break
+                    size, _ = self.record_header.unpack(header)
+                    data = f.read(size)
+                    found += 1
+                    yield segment, f.tell(), data
+
+    def __segment_path(self, segment):
+        return Path(self.root, f"{segment:016d}.seg")
+
+    def __open_writer(self):
+        self.writer = self.__segment_path(self.segments[-1]).open("ab")
+
+    def __rotate_writer(self):
+        self.writer.flush()
+        if self.sync:
+            os.fsync(self.writer.fileno())
+        self.writer.close()
+        self.segments.append(self.segments[-1] + 1)
+        self.__open_writer()
+
+    def __read_cursor(self):
+        try:
+            cursor = json.loads(self.cursor_path.read_text())
+            return cursor["segment"], cursor["offset"]
+        except FileNotFoundError:
+            return 0, 0
+        except (ValueError, KeyError):
+            logger.warning(
+                "outbox cursor %s is corrupt. replaying all segments.", self.cursor_path
+            )
+            return 0, 0
+
+    def __write_cursor(self):
+        tmp = self.cursor_path.with_suffix(".tmp")
+        tmp.write_text(
+            json.dumps({"segment": self.ack_segment, "offset": self.ack_offset})
+        )
+        os.replace(tmp, self.cursor_path)
+
+    def __recover_segments(self):
+        segments = sorted(int(p.stem) for p in self.root.glob("*.seg"))
+
+        # remove segments which were fully acknowledged before the last shutdown
+        for segment in segments:
+            if segment < self.ack_segment:
+                self.__segment_path(segment).unlink()
+        segments = [segment for segment in segments if segment >= self.ack_segment]
+
+        if len(segments) == 0:
+            self.ack_offset = 0
+            return [self.ack_segment]
+
+        if segments[0] != self.ack_segment:
+            self.ack_segment, self.ack_offset = segments[0], 0
+
+        for segment in segments:
+            offset = self.ack_offset if segment == self.ack_segment else 0
+            self.count += self.__recover_segment(segment, offset)
+
+        return segments
+
+    def __recover_segment(self, segment, offset):
+        # counts valid records in a segment and truncates any torn record left by a crash.
+        path = self.__segment_path(segment)
+        count = 0
+        with path.open("r+b") as f:
+            f.seek(offset)
+            while True:
+                start = f.tell()
+                header = f.read(self.record_header.size)
+                if len(header) == 0:
+                    break
+                if len(header) == self.record_header.size:
+                    size, crc = self.record_header.unpack(header)
+                    data = f.read(size)
+                    if len(data) == size and zlib.crc32(data) == crc:
+                        count += 1
+                        continue
+                logger.warning(
+                    "truncating torn record in outbox segment %s at %d", path, start
+                )
+                f.truncate(start)
+                break
+        return count
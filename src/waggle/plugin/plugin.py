@@ -1,47 +1,73 @@
+import json
 import logging
 import re
 import wagglemsg
 
 from contextlib import contextmanager
 from datetime import datetime
-from os import getenv
+from functools import lru_cache, partial
+from math import modf
+from os import getenv, stat
 from pathlib import Path
-from queue import Queue, Empty
-from threading import Event
-from typing import NamedTuple
+from queue import Queue, Empty, Full
+from threading import Event, Lock
+from time import monotonic
 
 from .config import PluginConfig
-from .rabbitmq import RabbitMQPublisher, RabbitMQConsumer
+from .queue import MessageQueue
+from .rabbitmq import RabbitMQPublisher, RabbitMQConsumer, PublishData, PublishBatch
 from .time import get_timestamp, timeit_perf_counter, timeit_perf_counter_duration
-from .uploader import Uploader
+from .uploader import Uploader, UploadPool
 
 
 logger = logging.getLogger(__name__)
 
 
-class PublishData(NamedTuple):
-    scope: str
-    body: bytes
-
-
 # Nanoseconds since epoch for 2000-01-01T00:00:00Z
 MIN_TIMESTAMP_NS = 946706400000000000
 
 
 class FilesystemPublisher:
-    def __init__(self, root):
+    """
+    FilesystemPublisher writes messages to a data.ndjson file and copies uploads to an uploads
+    directory under root.
+
+    Lines are buffered in memory and written once flush_size characters are buffered or
+    flush_interval seconds have passed since the last write. Any remaining lines are always
+    written by flush and close.
+    """
+
+    def __init__(self, root, flush_size=64 * 1024, flush_interval=1.0):
         self.root = Path(root)
         self.root.mkdir(parents=True, exist_ok=True)
         self.datafile = Path(root, "data.ndjson").open("a")
         self.uploads_dir = Path(root, "uploads")
         self.uploads_dir.mkdir(parents=True, exist_ok=True)
+        self.flush_size = flush_size
+        self.flush_interval = flush_interval
+        self.lock = Lock()
+        self.lines = []
+        self.lines_size = 0
+        self.last_flush = monotonic()
 
     def close(self):
-        self.datafile.close()
+        with self.lock:
+            self.__flush()
+            self.datafile.close()
+
+    def flush(self):
+        with self.lock:
+            self.__flush()
+
+    def __flush(self):
+        if len(self.lines) > 0:
+            self.datafile.write("".join(self.lines))
+            self.lines.clear()
+            self.lines_size = 0
+        self.datafile.flush()
+        self.last_flush = monotonic()
 
     def publish(self, msg: wagglemsg.Message):
-        import json
-
         out = {
             "name": msg.name,
             "value": msg.value,
@@ -49,11 +75,15 @@ class FilesystemPublisher:
             # python doesn't have builtin support for nanosecond
             "timestamp": isoformat_time_ns(msg.timestamp),
         }
-        print(
-            json.dumps(out, sort_keys=True, separators=(",", ":")),
-            file=self.datafile,
-            flush=True,
-        )
+        line = datafile_encoder.encode(out) + "\n"
+        with self.lock:
+            self.lines.append(line)
+            self.lines_size += len(line)
+            if (
+                self.lines_size >= self.flush_size
+                or monotonic() - self.last_flush >= self.flush_interval
+            ):
+                self.__flush()
 
     def upload_file(self, path, timestamp, meta):
         from shutil import copyfile
@@ -73,11 +103,30 @@ class FilesystemPublisher:
         )
 
 
+datafile_encoder = json.JSONEncoder(sort_keys=True, separators=(",", ":"))
+
+
 def isoformat_time_ns(ns: int) -> str:
     # python doesn't have builtin support for nanosecond timestamps and formatting, so we provide
     # a backfill for it. this is only intended to be used in the run log for testing.
+    #
+    # NOTE this gives the same output as datetime.fromtimestamp(ns / 1e9).isoformat() followed by
+    # the nanosecond digits, but only formats the date and time once per second. microseconds are
+    # rounded from the float timestamp exactly as datetime.fromtimestamp does.
     nanostr = f"{ns%1000:03d}"
-    return datetime.fromtimestamp(ns / 1e9).isoformat() + nanostr
+    frac, whole = modf(ns / 1e9)
+    us = round(frac * 1e6)
+    if us >= 1000000:
+        us -= 1000000
+        whole += 1
+    if us == 0:
+        return isoformat_seconds(int(whole)) + nanostr
+    return f"{isoformat_seconds(int(whole))}.{us:06d}{nanostr}"
+
+
+@lru_cache(maxsize=16)
+def isoformat_seconds(seconds: int) -> str:
+    return datetime.fromtimestamp(seconds).isoformat()
 
 
 class Plugin:
@@ -102,10 +151,16 @@ class Plugin:
     ):
         self.config = config or get_default_plugin_config()
         self.uploader = uploader or get_default_plugin_uploader()
-        self.send = Queue()
+        self.send = MessageQueue(
+            self.config.send_queue_size,
+            self.config.send_queue_policy,
+            self.config.send_queue_sample_interval,
+        )
         self.recv = Queue()
         self.stop = Event()
         self.tasks = []
+        self.publisher = None
+        self.upload_pool = None
 
         # TODO(sean) can we use ExitStack to clean up???
 
@@ -115,20 +170,64 @@ class Plugin:
             self.file_publisher = FilesystemPublisher(getenv("PYWAGGLE_LOG_DIR"))
 
     def __enter__(self):
-        self.tasks.append(RabbitMQPublisher(self.config, self.send, self.stop))
+        self.publisher = RabbitMQPublisher(self.config, self.send, self.stop)
+        self.tasks.append(self.publisher)
+        if self.config.upload_workers > 0:
+            self.upload_pool = UploadPool(
+                self.config.upload_workers, self.config.upload_max_pending_bytes
+            )
+        # finish any uploads interrupted by a previous run, in the background if possible
+        if self.uploader is not None:
+            if self.upload_pool is not None:
+                self.upload_pool.submit(0, self.__recover_uploads)
+            else:
+                self.__recover_uploads()
         return self
 
     def __exit__(self, exc_type, exc_value, exc_traceback):
+        # finish pending uploads first, so their upload messages are published before stopping
+        if self.upload_pool is not None:
+            self.upload_pool.close()
+            self.upload_pool = None
+
         self.stop.set()
 
         if self.file_publisher is not None:
             self.file_publisher.close()
 
+        for task in self.tasks:
+            task.wake()
+
         for task in self.tasks:
             task.done.wait()
 
         self.tasks.clear()
 
+    def metrics(self) -> dict:
+        """
+        metrics returns a snapshot of live publishing metrics such as messages per second, batch
+        confirm latency in seconds and the depth, high-water mark and drops of the send queue.
+        """
+        if self.publisher is None:
+            raise RuntimeError("Plugin can only be used inside a with block!")
+        metrics = {
+            "publisher": self.publisher.get_metrics(),
+            "send_queue": self.send.metrics(),
+        }
+        if self.upload_pool is not None:
+            metrics["uploads"] = self.upload_pool.metrics()
+        return metrics
+
+    def flush(self, timeout=None):
+        """
+        flush waits for pending background uploads to finish and writes any buffered log dir
+        messages. a TimeoutError is raised if uploads are still pending after timeout seconds.
+        """
+        if self.upload_pool is not None and not self.upload_pool.flush(timeout):
+            raise TimeoutError("plugin flush timed out")
+        if self.file_publisher is not None:
+            self.file_publisher.flush()
+
     def subscribe(self, *topics):
         self.tasks.append(RabbitMQConsumer(topics, self.config, self.recv, self.stop))
         # TODO(sean) add mock or integration testing against rabbitmq to actually test this
@@ -148,22 +247,54 @@ class Plugin:
         raise_for_invalid_publish_name(name)
         self.__publish(name, value, meta, timestamp, scope, timeout)
 
+    def publish_many(
+        self, records, meta={}, timestamp=None, scope="all", timeout=None
+    ):
+        """
+        publish_many publishes many measurements at once.
+
+        records can either be an iterable of (name, value), (name, value, meta) or
+        (name, value, meta, timestamp) tuples or a dictionary of columns with "name" and
+        "value" keys and optional "meta" and "timestamp" keys. The name column may also be a
+        single name used for every value. meta and timestamp are used for records which don't
+        provide their own.
+
+        All records are validated before any are published and are added to the outgoing queue
+        as a single item.
+        """
+        if len(self.tasks) == 0:
+            raise RuntimeError("Plugin can only be used inside a with block!")
+        # get timestamp before doing other work
+        timestamp = timestamp or get_timestamp()
+        if isinstance(records, dict):
+            columns = columns_from_dict(records, meta, timestamp)
+        else:
+            columns = columns_from_records(records, meta, timestamp)
+        names, values, metas, timestamps = columns
+        if len(names) == 0:
+            return
+        raise_for_invalid_publish_columns(names, values, metas, timestamps)
+
+        if self.file_publisher is not None:
+            for record in zip(*columns):
+                self.file_publisher.publish(
+                    wagglemsg.Message(
+                        name=record[0],
+                        value=record[1],
+                        meta=record[2],
+                        timestamp=record[3],
+                    )
+                )
+
+        bodies = [dump_message(*record) for record in zip(*columns)]
+        logger.debug("adding %d messages to outgoing queue", len(bodies))
+        self.__put(PublishBatch(scope, bodies), timeout)
+
     # NOTE __publish is used internally by publish and upload_file to do an unchecked
     # message publish. the main reason this exists is to guard against reserved names
     # like "upload" in publish but still allow upload_file to use it.
     def __publish(self, name, value, meta, timestamp, scope="all", timeout=None):
-        if not isinstance(value, (int, float, str)):
-            raise TypeError("Value must be an int, float or str.")
-        if not isinstance(timestamp, int):
-            raise TypeError(
-                "Timestamp must be an int and have units of nanoseconds since epoch. Please see the documentation for more information on setting timestamps."
-            )
-        if timestamp < MIN_TIMESTAMP_NS:
-            raise ValueError(
-                "Timestamp probably has wrong units and is being processed as before 2000-01-01T00:00:00Z. Timestamp must have units of nanoseconds since epoch. Please see the documentation for more information on setting timestamps."
-            )
-        if not valid_meta(meta):
-            raise TypeError("Meta must be a dictionary of strings to strings.")
+        raise_for_invalid_publish_args(value, meta, timestamp)
         msg = wagglemsg.Message(name=name, value=value, timestamp=timestamp, meta=meta)
 
         # hack to use file publisher for everything except uploads
@@ -171,12 +302,37 @@ class Plugin:
             self.file_publisher.publish(msg)
 
         logger.debug("adding message to outgoing queue: %s", msg)
-        self.send.put(PublishData(scope, wagglemsg.dump(msg)), timeout=timeout)
+        self.__put(PublishData(scope, wagglemsg.dump(msg)), timeout)
+
+    def __put(self, item, timeout):
+        try:
+            self.send.put(item, timeout=timeout)
+            return
+        except Full:
+            pass
+        raise TimeoutError("plugin publish timed out")
 
-    def upload_file(self, path, meta={}, timestamp=None, keep=False):
+    def upload_file(self, path, meta={}, timestamp=None, keep=False, timeout=None):
+        """
+        upload_file stages a file for upload and publishes an upload message once it's staged.
+
+        When config.upload_workers is set, uploads inside a with block are done in the background
+        and a Future is returned. The file must not be modified until the upload is done. timeout
+        limits how long to wait when upload_max_pending_bytes of uploads are already pending.
+        """
         # get timestamp before doing other work
         timestamp = timestamp or get_timestamp()
 
+        if self.upload_pool is not None:
+            return self.upload_pool.submit(
+                stat(path).st_size,
+                partial(self.__upload_file, path, meta, timestamp, keep),
+                timeout,
+            )
+
+        self.__upload_file(path, meta, timestamp, keep)
+
+    def __upload_file(self, path, meta, timestamp, keep):
         if self.file_publisher is not None:
             self.file_publisher.upload_file(path, meta=meta, timestamp=timestamp)
 
@@ -187,9 +343,23 @@ class Plugin:
                 path=path, meta=meta, timestamp=timestamp, keep=keep
             )
             self.__publish("upload", upload_path.name, meta, timestamp)
+            return upload_path
+
+    def __recover_uploads(self):
+        try:
+            recovered = self.uploader.recover()
+        except Exception:
+            logger.exception("failed to recover uploads")
+            return
+        for upload_path, meta in recovered:
+            self.__publish(
+                "upload", upload_path.name, meta["labels"], meta["timestamp"]
+            )
 
     @contextmanager
     def timeit(self, name):
+        # check name up front so an invalid name fails before running the timed block
+        raise_for_invalid_publish_name(name)
         logger.debug("starting timeit block %s", name)
         start = timeit_perf_counter()
         yield
@@ -209,6 +379,96 @@ def get_default_plugin_config() -> PluginConfig:
     )
 
 
+def raise_for_invalid_publish_args(value, meta, timestamp):
+    raise_for_invalid_publish_value(value)
+    raise_for_invalid_publish_timestamp(timestamp)
+    raise_for_invalid_publish_meta(meta)
+
+
+def raise_for_invalid_publish_value(value):
+    if not isinstance(value, (int, float, str)):
+        raise TypeError("Value must be an int, float or str.")
+
+
+def raise_for_invalid_publish_timestamp(timestamp):
+    if not isinstance(timestamp, int):
+        raise TypeError(
+            "Timestamp must be an int and have units of nanoseconds since epoch. Please see the documentation for more information on setting timestamps."
+        )
+    if timestamp < MIN_TIMESTAMP_NS:
+        raise ValueError(
+            "Timestamp probably has wrong units and is being processed as before 2000-01-01T00:00:00Z. Timestamp must have units of nanoseconds since epoch. Please see the documentation for more information on setting timestamps."
+        )
+
+
+def raise_for_invalid_publish_meta(meta):
+    if not valid_meta(meta):
+        raise TypeError("Meta must be a dictionary of strings to strings.")
+
+
+def raise_for_invalid_publish_columns(names, values, metas, timestamps):
+    # NOTE validity only depends on the name, the type of the value and timestamp and the meta
+    # object itself, so we check each distinct one once instead of once per record.
+    for name in set(names):
+        raise_for_invalid_publish_name(name)
+    for value in first_of_each_type(values):
+        raise_for_invalid_publish_value(value)
+    for timestamp in first_of_each_type(timestamps):
+        raise_for_invalid_publish_timestamp(timestamp)
+    raise_for_invalid_publish_timestamp(min(timestamps))
+    for meta in {id(meta): meta for meta in metas}.values():
+        raise_for_invalid_publish_meta(meta)
+
+
+def first_of_each_type(items):
+    return {type(item): item for item in items}.values()
+
+
+def columns_from_records(records, meta, timestamp):
+    names, values, metas, timestamps = [], [], [], []
+    for record in records:
+        names.append(record[0])
+        values.append(record[1])
+        metas.append(record[2] if len(record) > 2 and record[2] is not None else meta)
+        timestamps.append(
+            record[3] if len(record) > 3 and record[3] is not None else timestamp
+        )
+    return names, values, metas, timestamps
+
+
+def columns_from_dict(columns, meta, timestamp):
+    values = column_to_list(columns["value"])
+    n = len(values)
+    names = columns["name"]
+    if isinstance(names, str):
+        names = [names] * n
+    else:
+        names = column_to_list(names)
+    metas = column_to_list(columns.get("meta", [meta] * n))
+    timestamps = column_to_list(columns.get("timestamp", [timestamp] * n))
+    if not (len(names) == len(metas) == len(timestamps) == n):
+        raise ValueError("publish_many columns must all have the same length.")
+    return names, values, metas, timestamps
+
+
+def column_to_list(column):
+    # convert array types like numpy arrays into lists of builtin python types
+    if hasattr(column, "tolist"):
+        return column.tolist()
+    return list(column)
+
+
+# NOTE reusing a single encoder gives the same output as wagglemsg.dump for non-binary values
+# without building a new encoder for every message.
+message_encoder = json.JSONEncoder(separators=(",", ":"))
+
+
+def dump_message(name, value, meta, timestamp) -> str:
+    return message_encoder.encode(
+        {"name": name, "ts": timestamp, "meta": meta, "val": value}
+    )
+
+
 def valid_meta(meta):
     return isinstance(meta, dict) and all(isinstance(v, str) for v in meta.values())
 
@@ -222,19 +482,30 @@ def get_default_plugin_uploader():
     return Uploader(Path(getenv("WAGGLE_PLUGIN_UPLOAD_PATH", "/run/waggle/uploads")))
 
 
-publish_name_part_pattern = re.compile("^[a-z0-9_]+$")
+publish_name_pattern = re.compile(r"[a-z0-9_]+(\.[a-z0-9_]+)*")
+publish_name_part_pattern = re.compile(r"[a-z0-9_]+")
+
+# NOTE plugins tend to publish the same handful of names many times, so we remember names which
+# have already passed validation. the cache is cleared when full to bound its size.
+valid_publish_names = set()
+valid_publish_names_max_size = 4096
 
 
 def raise_for_invalid_publish_name(s: str):
+    if type(s) is str and s in valid_publish_names:
+        return
     if not isinstance(s, str):
         raise TypeError(f"publish name must be a string: {s!r}")
     if len(s) > 128:
         raise ValueError(f"publish must be at most 128 characters: {s!r}")
     if s == "upload":
         raise ValueError(f"name {s!r} is reserved for system use only")
-    parts = s.split(".")
-    for p in parts:
-        if not publish_name_part_pattern.match(p):
-            raise ValueError(
-                f"publish name invalid: {s!r} part: {p!r} (names must consist of [a-z0-9_] and may be joined by .)"
-            )
+    if not publish_name_pattern.fullmatch(s):
+        # find the first invalid part to provide a more helpful error
+        p = next(p for p in s.split(".") if not publish_name_part_pattern.fullmatch(p))
+        raise ValueError(
+            f"publish name invalid: {s!r} part: {p!r} (names must consist of [a-z0-9_] and may be joined by .)"
+        )
+    if len(valid_publish_names) >= valid_publish_names_max_size:
+        valid_publish_names.clear()
+    valid_publish_names.add(s)
@@ -0,0 +1,102 @@
+from queue import Queue, Empty
+from time import monotonic
+
+
+MESSAGE_QUEUE_POLICIES = {"block", "drop_newest", "drop_oldest", "sample"}
+
+
+class MessageQueue(Queue):
+    """
+    MessageQueue is a Queue which can be closed to immediately wake up any blocked consumers.
+
+    Once closed, get behaves as usual while items remain and raises Empty instead of blocking
+    when the queue is empty.
+
+    When maxsize is greater than zero, policy decides what happens when putting into a full queue:
+
+    * block - put blocks until there is space or the timeout expires and raises Full.
+    * drop_newest - the new item is discarded.
+    * drop_oldest - the oldest queued item is discarded to make room for the new item.
+    * sample - one of every sample_interval new items replaces the oldest queued item and the
+      rest are discarded.
+    """
+
+    def __init__(self, maxsize=0, policy="block", sample_interval=10):
+        if policy not in MESSAGE_QUEUE_POLICIES:
+            raise ValueError(
+                f"invalid queue policy {policy!r}. must be one of {sorted(MESSAGE_QUEUE_POLICIES)}"
+            )
+        if sample_interval <= 0:
+            raise ValueError("sample interval must be positive")
+        super().__init__(maxsize)
+        self.closed = False
+        self.policy = policy
+        self.sample_interval = sample_interval
+        self.sample_count = 0
+        self.enqueued = 0
+        self.dropped = 0
+        self.high_water = 0
+
+    def close(self):
+        with self.mutex:
+            self.closed = True
+            self.not_empty.notify_all()
+
+    def metrics(self) -> dict:
+        with self.mutex:
+            return {
+                "depth": self._qsize(),
+                "max_depth": self.maxsize,
+                "high_water": self.high_water,
+                "enqueued": self.enqueued,
+                "dropped": self.dropped,
+            }
+
+    def put(self, item, block=True, timeout=None):
+        if self.policy == "block" or self.maxsize <= 0:
+            return super().put(item, block, timeout)
+        with self.mutex:
+            if self._qsize() >= self.maxsize:
+                self.dropped += 1
+                if self.policy == "drop_newest":
+                    return
+                if self.policy == "sample":
+                    self.sample_count += 1
+                    if self.sample_count % self.sample_interval != 0:
+                        return
+                self._get()
+                self.unfinished_tasks -= 1
+            self._put(item)
+            self.unfinished_tasks += 1
+            self.not_empty.notify()
+
+    def _put(self, item):
+        super()._put(item)
+        self.enqueued += 1
+        if self._qsize() > self.high_water:
+            self.high_water = self._qsize()
+
+    def get(self, block=True, timeout=None):
+        with self.not_empty:
+            if not block:
+                if not self._qsize():
+                    raise Empty
+            elif timeout is None:
+                while not self._qsize():
+                    if self.closed:
+                        raise Empty
+                    self.not_empty.wait()
+            elif timeout < 0:
+                raise ValueError("'timeout' must be a non-negative number")
+            else:
+                endtime = monotonic() + timeout
+                while not self._qsize():
+                    if self.closed:
+                        raise Empty
+                    remaining = endtime - monotonic()
+                    if remaining <= 0.0:
+                        raise Empty
+                    self.not_empty.wait(remaining)
+            item = self._get()
+            self.not_full.notify()
+            return item
@@ -1,11 +1,15 @@
 import logging
-from threading import Thread, Event
+from collections import deque
+from itertools import islice
+from threading import Thread, Event, Lock
 from queue import Queue, Empty
+from typing import NamedTuple
 import time
 import pika
 import pika.exceptions
 import wagglemsg
 from .config import PluginConfig
+from .outbox import Outbox
 
 
 logger = logging.getLogger(__name__)
@@ -13,11 +17,29 @@ logger = logging.getLogger(__name__)
 logging.getLogger("pika").setLevel(logging.CRITICAL)
 
 
+class PublishData(NamedTuple):
+    scope: str
+    body: bytes
+
+
+class PublishBatch(NamedTuple):
+    scope: str
+    bodies: list
+
+
 class RabbitMQPublisher:
     """
     RabbitMQPublisher manages a connection to RabbitMQ and publishes messages from the provided queue.
 
-    This is done in a background thread which must be stopped by setting the provided stop Event.
+    This is done in a background thread which must be stopped by setting the provided stop Event
+    and then calling wake.
+
+    When config.publish_batch_size is greater than zero, messages are published in batches which
+    are each acknowledged by the broker before being considered sent.
+
+    Messages which have been taken from the queue but not yet sent are held in a RetryBuffer and
+    are replayed in their original order after a reconnect, before any newer messages. When
+    config.publish_outbox_dir is set, they are held in a persistent Outbox instead.
     """
 
     def __init__(self, config: PluginConfig, messages: Queue, stop: Event):
@@ -26,8 +48,36 @@ class RabbitMQPublisher:
         self.messages = messages
         self.stop = stop
         self.done = Event()
+        self.batching = config.publish_batch_size > 0
+        # NOTE properties are the same for every message, so we build them once and reuse them.
+        self.properties = get_publish_properties(config)
+        self.metrics = PublisherMetrics()
+        if config.publish_outbox_dir != "":
+            self.pending = OutboxBuffer(
+                Outbox(config.publish_outbox_dir, config.publish_outbox_segment_size)
+            )
+            # take everything already waiting in the queue so the outbox can group commit it
+            self.fill_size = max(config.publish_batch_size, OUTBOX_GROUP_COMMIT_SIZE)
+        else:
+            self.pending = RetryBuffer(
+                config.publish_retry_buffer_size,
+                config.publish_retry_overflow,
+                config.publish_spill_dir,
+            )
+            self.fill_size = max(config.publish_batch_size, 1)
+        self.fill_timeout = config.publish_batch_timeout if self.batching else 0
         Thread(target=self.__main).start()
 
+    def wake(self):
+        # closing the queue immediately wakes the background thread if it is waiting for messages
+        self.messages.close()
+
+    def get_metrics(self) -> dict:
+        metrics = self.metrics.snapshot()
+        metrics["retry_buffer_length"] = len(self.pending)
+        metrics["retry_buffer_dropped"] = self.pending.dropped
+        return metrics
+
     def __main(self):
         logger.debug("publisher started.")
         try:
@@ -37,66 +87,314 @@ class RabbitMQPublisher:
                 except Exception:
                     if logger.isEnabledFor(logging.DEBUG):
                         logger.exception("__connect_and_flush_messages exception")
-                    time.sleep(1)
+                    self.__buffer_messages(1.0)
+            # keep anything left in the queue when using a persistent outbox
+            if isinstance(self.pending, OutboxBuffer):
+                self.__buffer_messages(0)
         finally:
+            self.pending.close()
             self.done.set()
             logger.debug("publisher stopped.")
 
     def __connect_and_flush_messages(self):
         logger.debug("publisher connecting to rabbitmq...")
         with pika.BlockingConnection(self.params) as conn, conn.channel() as ch:
+            if self.batching:
+                # NOTE BlockingChannel waits for a confirm after every basic_publish once
+                # confirm_delivery is enabled, so batches are committed as a transaction to
+                # get a single acknowledgement per batch instead.
+                ch.tx_select()
             while not self.stop.is_set():
                 self.__flush_messages(ch)
+                # service heartbeats and other connection events while idle
+                conn.process_data_events(time_limit=0)
             logger.debug("publisher stopping...")
             # attempt to flush any remaining messages
             self.__flush_messages(ch)
 
-    def __flush_messages(self, ch):
+    def __buffer_messages(self, duration):
+        # while disconnected, keep moving messages into the retry buffer so its overflow
+        # policy bounds memory use during broker outages.
+        deadline = time.monotonic() + duration
         while True:
+            remaining = max(deadline - time.monotonic(), 0)
+            if self.pending.full():
+                self.stop.wait(remaining)
+                return
             try:
-                logger.debug("publisher checking for message...")
-                item = self.messages.get(timeout=1)
+                self.pending.extend(
+                    expand_batches(
+                        get_batch(self.messages, self.fill_size, 0, wait=remaining)
+                    )
+                )
             except Empty:
                 return
 
-            properties = pika.BasicProperties(
-                delivery_mode=2, user_id=self.params.credentials.username
-            )
-
-            # NOTE app_id is used by data service to validate and tag additional metadata provided by k3s scheduler.
-            if self.config.app_id != "":
-                properties.app_id = self.config.app_id
+    def __flush_messages(self, ch):
+        batch_size = max(self.config.publish_batch_size, 1)
+        while True:
+            # replay any unacknowledged messages before taking new ones
+            if len(self.pending) == 0:
+                try:
+                    logger.debug("publisher checking for message...")
+                    self.pending.extend(
+                        expand_batches(
+                            get_batch(
+                                self.messages,
+                                self.fill_size,
+                                self.fill_timeout,
+                                wait=IDLE_WAKEUP_INTERVAL,
+                            )
+                        )
+                    )
+                except Empty:
+                    return
+            batch = self.pending.peek(batch_size)
+            self.__publish_batch(ch, batch)
+            self.pending.ack(len(batch))
 
-            if logger.isEnabledFor(logging.DEBUG):
-                logger.debug(
-                    "publishing message to rabbitmq: %s", wagglemsg.load(item.body)
-                )
+    def __publish_batch(self, ch, batch):
+        properties = self.properties
+        basic_publish = ch.basic_publish
 
-            try:
-                ch.basic_publish(
+        try:
+            for item in batch:
+                if logger.isEnabledFor(logging.DEBUG):
+                    logger.debug(
+                        "publishing message to rabbitmq: %s", wagglemsg.load(item.body)
+                    )
+                basic_publish(
                     exchange="to-validator",
                     routing_key=item.scope,
                     properties=properties,
                     body=item.body,
                 )
-            except Exception:
-                if logger.isEnabledFor(logging.DEBUG):
-                    logger.exception(
-                        "basic_publish to rabbitmq failed. will requeue message..."
-                    )
-                # requeue message so we can again later
-                # NOTE(sean) this will reorder messages. if we realized we *must* preserve message
-                # order, we must to change this to avoid subtle bugs!
-                self.messages.put(item)
-                # propagate error up to trigger reconnect
-                raise
+            if self.batching:
+                # wait for a single broker acknowledgement covering the whole batch
+                start = time.monotonic()
+                ch.tx_commit()
+                self.metrics.record_confirm(time.monotonic() - start)
+        except Exception:
+            if logger.isEnabledFor(logging.DEBUG):
+                logger.exception(
+                    "basic_publish to rabbitmq failed. will retry messages..."
+                )
+            # NOTE messages stay in the retry buffer until they are acknowledged, so they
+            # will be replayed in order after we reconnect.
+            # propagate error up to trigger reconnect
+            raise
+
+        self.metrics.record_published(len(batch))
+
+
+class PublisherMetrics:
+    """
+    PublisherMetrics tracks throughput and confirm latency of a RabbitMQPublisher.
+    """
+
+    def __init__(self):
+        self.messages_published = 0
+        self.batches_confirmed = 0
+        self.confirm_latency_last = 0.0
+        self.confirm_latency_total = 0.0
+        self.first_publish_time = None
+
+    def record_published(self, n):
+        if self.first_publish_time is None:
+            self.first_publish_time = time.monotonic()
+        self.messages_published += n
+
+    def record_confirm(self, latency):
+        self.batches_confirmed += 1
+        self.confirm_latency_last = latency
+        self.confirm_latency_total += latency
+
+    def snapshot(self) -> dict:
+        if self.first_publish_time is None:
+            rate = 0.0
+        else:
+            elapsed = time.monotonic() - self.first_publish_time
+            rate = self.messages_published / elapsed if elapsed > 0 else 0.0
+        if self.batches_confirmed > 0:
+            latency_mean = self.confirm_latency_total / self.batches_confirmed
+        else:
+            latency_mean = 0.0
+        return {
+            "messages_published": self.messages_published,
+            "messages_per_second": rate,
+            "batches_confirmed": self.batches_confirmed,
+            "confirm_latency_last": self.confirm_latency_last,
+            "confirm_latency_mean": latency_mean,
+        }
+
+
+# maximum time in seconds the publisher waits for messages before servicing connection events.
+# this must be well under the heartbeat timeout negotiated with the broker.
+IDLE_WAKEUP_INTERVAL = 10.0
+
+# maximum number of queued messages written to the outbox with a single fsync
+OUTBOX_GROUP_COMMIT_SIZE = 1000
+
+RETRY_OVERFLOW_POLICIES = {"block", "drop_oldest", "spill"}
+
+
+class RetryBuffer:
+    """
+    RetryBuffer holds messages which have been taken from the send queue but not yet
+    acknowledged by the broker, in their original order.
+
+    Once maxsize messages are buffered, the overflow policy decides what happens next:
+
+    * block - the publisher stops taking new messages until the buffer drains.
+    * drop_oldest - the oldest buffered message is discarded to make room.
+    * spill - newer messages are written to a spill file under spill_dir and read back in order.
+    """
+
+    def __init__(self, maxsize: int, overflow: str = "block", spill_dir: str = ""):
+        if maxsize <= 0:
+            raise ValueError("retry buffer size must be positive")
+        if overflow not in RETRY_OVERFLOW_POLICIES:
+            raise ValueError(
+                f"invalid retry overflow policy {overflow!r}. must be one of {sorted(RETRY_OVERFLOW_POLICIES)}"
+            )
+        if overflow == "spill" and spill_dir == "":
+            raise ValueError("spill overflow policy requires a spill directory")
+        self.maxsize = maxsize
+        self.overflow = overflow
+        self.items = deque()
+        self.dropped = 0
+        self.spill = None
+        if overflow == "spill":
+            # NOTE the spill outbox is only used as overflow storage, so we skip fsync.
+            self.spill = Outbox(spill_dir, sync=False)
+
+    def __len__(self):
+        if self.spill is None:
+            return len(self.items)
+        return len(self.items) + len(self.spill)
+
+    def full(self) -> bool:
+        return self.overflow == "block" and len(self.items) >= self.maxsize
+
+    def append(self, item: PublishData):
+        # once anything has spilled, newer messages must follow it to disk to preserve order
+        if self.spill is not None and (
+            len(self.spill) > 0 or len(self.items) >= self.maxsize
+        ):
+            self.spill.append(encode_publish_data(item))
+            return
+        if self.overflow == "drop_oldest" and len(self.items) >= self.maxsize:
+            self.items.popleft()
+            self.dropped += 1
+        self.items.append(item)
+
+    def extend(self, items):
+        for item in items:
+            self.append(item)
+
+    def peek(self, n: int) -> list:
+        if self.spill is not None and len(self.items) < n and len(self.spill) > 0:
+            records = self.spill.peek(self.maxsize - len(self.items))
+            self.items.extend(decode_publish_data(data) for data in records)
+            self.spill.ack(len(records))
+        return list(islice(self.items, n))
+
+    def ack(self, n: int):
+        for _ in range(n):
+            self.items.popleft()
+
+    def close(self):
+        if self.spill is not None:
+            self.spill.close()
+
+
+class OutboxBuffer:
+    """
+    OutboxBuffer provides the RetryBuffer interface on top of a persistent Outbox, so every
+    message taken by the publisher is kept on disk until the broker has acknowledged it.
+    """
+
+    def __init__(self, outbox: Outbox):
+        self.outbox = outbox
+        self.dropped = 0
+
+    def __len__(self):
+        return len(self.outbox)
+
+    def full(self) -> bool:
+        return False
+
+    def append(self, item: PublishData):
+        self.outbox.append(encode_publish_data(item))
+
+    def extend(self, items):
+        self.outbox.extend([encode_publish_data(item) for item in items])
+
+    def peek(self, n: int) -> list:
+        return [decode_publish_data(data) for data in self.outbox.peek(n)]
+
+    def ack(self, n: int):
+        self.outbox.ack(n)
+
+    def close(self):
+        self.outbox.close()
+
+
+def encode_publish_data(item: PublishData) -> bytes:
+    body = item.body
+    if isinstance(body, str):
+        body = body.encode()
+    return item.scope.encode() + b"\n" + body
+
+
+def decode_publish_data(data: bytes) -> PublishData:
+    scope, body = data.split(b"\n", 1)
+    return PublishData(scope.decode(), body)
+
+
+def expand_batches(items):
+    # PublishBatch items added by Plugin.publish_many are expanded into individual messages
+    for item in items:
+        if isinstance(item, PublishBatch):
+            for body in item.bodies:
+                yield PublishData(item.scope, body)
+        else:
+            yield item
+
+
+def get_batch(messages: Queue, size: int, timeout: float, wait: float = 1.0) -> list:
+    """
+    get_batch waits up to wait seconds for the first item in messages and then drains up to size
+    items in total, waiting at most timeout seconds for the rest of the batch. Raises Empty if no
+    item arrives.
+    """
+    if wait > 0:
+        batch = [messages.get(timeout=wait)]
+    else:
+        batch = [messages.get_nowait()]
+    deadline = time.monotonic() + timeout
+    while len(batch) < size:
+        try:
+            batch.append(messages.get_nowait())
+            continue
+        except Empty:
+            pass
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            break
+        try:
+            batch.append(messages.get(timeout=remaining))
+        except Empty:
+            break
+    return batch
 
 
 class RabbitMQConsumer:
     """
     RabbitMQConsumer manages a connection to RabbitMQ and puts received messages into the provided queue.
 
-    This is done in a background thread which must be stopped by setting the provided stop Event.
+    This is done in a background thread which must be stopped by setting the provided stop Event
+    and then calling wake.
     """
 
     def __init__(self, topics, config: PluginConfig, messages: Queue, stop: Event):
@@ -106,8 +404,21 @@ class RabbitMQConsumer:
         self.messages = messages
         self.stop = stop
         self.done = Event()
+        self.lock = Lock()
+        self.connection = None
+        self.channel = None
         Thread(target=self.__main).start()
 
+    def wake(self):
+        with self.lock:
+            if self.connection is None:
+                return
+            try:
+                self.connection.add_callback_threadsafe(self.channel.stop_consuming)
+            except Exception:
+                # connection is already closing, so the background thread will notice stop.
+                pass
+
     def __main(self):
         logger.debug("consumer started.")
         try:
@@ -117,7 +428,7 @@ class RabbitMQConsumer:
                 except Exception:
                     if logger.isEnabledFor(logging.DEBUG):
                         logger.exception("__connect_and_consume_messages exception")
-                    time.sleep(1)
+                    self.stop.wait(1)
         finally:
             self.done.set()
             logger.debug("consumer stopped.")
@@ -133,16 +444,19 @@ class RabbitMQConsumer:
                 ch.queue_bind(queue, "data.topic", topic)
                 logger.debug("consumer binding queue %s to topic %s", queue, topic)
 
-            def check_stop():
+            # NOTE once connection is set, wake will stop consuming from any thread. we check
+            # stop afterwards so a wake which happened before this point is not missed.
+            with self.lock:
+                self.connection, self.channel = conn, ch
+            try:
                 if self.stop.is_set():
-                    logger.debug("consumer stopping...")
-                    ch.stop_consuming()
-                else:
-                    conn.call_later(1, check_stop)
-
-            conn.call_later(1, check_stop)
-            logger.debug("consumer start processing messages...")
-            ch.start_consuming()
+                    return
+                logger.debug("consumer start processing messages...")
+                ch.start_consuming()
+                logger.debug("consumer stopping...")
+            finally:
+                with self.lock:
+                    self.connection, self.channel = None, None
 
     def __process_message(self, ch, method, properties, body):
         try:
@@ -155,6 +469,14 @@ class RabbitMQConsumer:
         self.messages.put(msg)
 
 
+def get_publish_properties(config: PluginConfig) -> pika.BasicProperties:
+    properties = pika.BasicProperties(delivery_mode=2, user_id=config.username)
+    # NOTE app_id is used by data service to validate and tag additional metadata provided by k3s scheduler.
+    if config.app_id != "":
+        properties.app_id = config.app_id
+    return properties
+
+
 def get_connection_parameters_for_config(
     config: PluginConfig,
 ) -> pika.ConnectionParameters:
@@ -1,60 +1,719 @@
+import errno
 import hashlib
 import json
+import logging
+import os
+import shutil
+import tempfile
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
 from pathlib import Path
-from shutil import copyfile
+from threading import Condition, Lock
+from time import time
 from .time import get_timestamp
 
+# NOTE staging dirs are only locked on platforms with fcntl.
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+logger = logging.getLogger(__name__)
+
+# size of buffer used when reading and copying files
+COPY_BUFFER_SIZE = 1024 * 1024
+
+# files larger than this are staged in chunks which can be resumed after a crash
+DEFAULT_CHUNK_SIZE = 64 * 1024 * 1024
+
+# lock files older than this without a staging dir are left over from a crash
+STALE_LOCK_FILE_AGE = 3600
+
+COMPRESSION_CODECS = {"gzip", "zstd"}
+
+# NOTE files with these extensions or starting with these magic bytes are already compressed, so
+# they are staged as is.
+COMPRESSED_EXTENSIONS = {
+    ".7z",
+    ".avi",
+    ".bz2",
+    ".flac",
+    ".gif",
+    ".gz",
+    ".heic",
+    ".jpeg",
+    ".jpg",
+    ".mkv",
+    ".mov",
+    ".mp3",
+    ".mp4",
+    ".npz",
+    ".ogg",
+    ".png",
+    ".webm",
+    ".webp",
+    ".xz",
+    ".zip",
+    ".zst",
+}
+
+COMPRESSED_MAGIC_BYTES = (
+    b"\x1f\x8b",  # gzip
+    b"\x28\xb5\x2f\xfd",  # zstd
+    b"BZh",  # bzip2
+    b"\xfd7zXZ\x00",  # xz
+    b"7z\xbc\xaf",  # 7z
+    b"PK\x03\x04",  # zip, npz
+    b"\xff\xd8\xff",  # jpeg
+    b"\x89PNG",  # png
+    b"GIF8",  # gif
+    b"OggS",  # ogg
+    b"fLaC",  # flac
+    b"ID3",  # mp3
+    b"\x1a\x45\xdf\xa3",  # mkv, webm
+)
+
 
 class Uploader:
-    def __init__(self, root):
+    """
+    Uploader stages files in root to be uploaded.
+
+    When dedup_window is greater than zero, files with the same contents as a file staged in the
+    last dedup_window seconds are hard linked to the existing data instead of being copied. The
+    checksums of recent uploads are kept in an index file next to root, or at dedup_index_path.
+
+    When compression is "gzip" or "zstd", files are compressed while being staged unless they are
+    already in a compressed format. The codec is recorded in the compression label of the meta
+    and compression_level defaults to the codec's default level. zstd requires the zstandard
+    module.
+
+    Copies of files larger than chunk_size are staged in chunks which are tracked in a manifest,
+    so an upload interrupted by a crash can be resumed by recover instead of being restaged.
+    """
+
+    def __init__(
+        self,
+        root,
+        dedup_window=0,
+        dedup_index_path=None,
+        compression=None,
+        compression_level=None,
+        chunk_size=DEFAULT_CHUNK_SIZE,
+    ):
         self.root = Path(root)
+        if compression is not None and compression not in COMPRESSION_CODECS:
+            raise ValueError(
+                f"invalid compression {compression!r}. must be one of {sorted(COMPRESSION_CODECS)}"
+            )
+        if chunk_size <= 0:
+            raise ValueError("chunk size must be positive")
+        self.compression = compression
+        self.compression_level = compression_level
+        self.chunk_size = chunk_size
+        # fail early if the optional zstandard module is missing
+        if compression == "zstd":
+            import zstandard  # noqa: F401
+
+        self.dedup_index = None
+        if dedup_window > 0:
+            if dedup_index_path is None:
+                dedup_index_path = Path(
+                    self.root.parent, f".{self.root.name}-dedup-index"
+                )
+            self.dedup_index = DedupIndex(dedup_index_path, dedup_window)
 
     # NOTE uploads are stored in the following directory structure:
     # root/
     #   timestamp-sha1sum/
     #     data
     #     meta
+    #
+    # files are staged in a hidden .partial-* directory in root which is renamed once complete,
+    # so a timestamp-sha1sum directory is never seen with partial data or missing meta. meta is
+    # always written once data is complete, so a staging dir with both is ready to be renamed.
+    # each staging dir is locked by a .partial-*.lock file while in use.
     def upload_file(self, path, meta={}, timestamp=None, keep=False):
         # get timestamp before doing other work
         timestamp = timestamp or get_timestamp()
 
         path = Path(path)
-        checksum = sha1sum_for_file(path)
+        labels = {k: v for k, v in meta.items()}
+        labels["filename"] = path.name
+        compression = self.__compression_for_file(path)
+        if compression is not None:
+            labels["compression"] = compression
 
-        # create upload dir
-        upload_dir = Path(self.root, f"{timestamp}-{checksum}")
-        upload_dir.mkdir(parents=True, exist_ok=True)
+        self.root.mkdir(parents=True, exist_ok=True)
+        staging_dir, lock = create_staging_dir(self.root)
+        data_path = Path(staging_dir, "data")
+        moved = False
+
+        try:
+            # stage data file
+            # NOTE we move the file when it's not kept and is on the same filesystem as the upload
+            # dir. otherwise, we copy it as the upload dir may be mounted from another disk.
+            source_checksum = None
+            checksum = None
+            if self.dedup_index is not None:
+                source_checksum = sha1sum_for_file(path)
+                checksum = self.__link_duplicate(
+                    source_checksum, compression, data_path
+                )
+            if (
+                checksum is None
+                and compression is None
+                and not keep
+                and same_filesystem(path, self.root)
+            ):
+                checksum = source_checksum or sha1sum_for_file(path)
+                write_meta_file(staging_dir, timestamp, checksum, labels)
+                moved = move_file(path, data_path)
+                if not moved:
+                    checksum = None
+                    Path(staging_dir, "meta").unlink()
+            if checksum is None:
+                checksum = self.__copy_to_staging_dir(
+                    path, staging_dir, timestamp, labels, compression, keep
+                )
 
-        # stage data file
-        # NOTE we do a copy instead of move, as the upload dir may
-        # be mounted from another disk.
-        copyfile(path, Path(upload_dir, "data"))
-        if not keep:
+            if not moved:
+                write_meta_file(staging_dir, timestamp, checksum, labels)
+            upload_dir = self.__finish_staging_dir(staging_dir, timestamp, checksum)
+        except BaseException:
+            if moved:
+                os.rename(data_path, path)
+            shutil.rmtree(staging_dir, ignore_errors=True)
+            raise
+        finally:
+            release_staging_dir(staging_dir, lock)
+
+        if not keep and not moved:
             path.unlink()
 
-        # stage meta file
-        metafile = {
+        # NOTE we point the index at the newest upload dir, as older ones are more likely to have
+        # already been uploaded and removed.
+        if self.dedup_index is not None:
+            self.dedup_index.add(source_checksum, upload_dir.name)
+
+        return upload_dir
+
+    def __copy_to_staging_dir(
+        self, path, staging_dir, timestamp, labels, compression, keep
+    ):
+        source_stat = path.stat()
+        if source_stat.st_size <= self.chunk_size:
+            return copy_file_with_sha1sum(
+                path,
+                Path(staging_dir, "data"),
+                self.__new_compressor(compression, self.compression_level),
+            )
+        manifest = {
+            "source": str(path.absolute()),
+            "size": source_stat.st_size,
+            "mtime_ns": source_stat.st_mtime_ns,
+            "keep": keep,
             "timestamp": timestamp,
-            "shasum": checksum,
-            "labels": {k: v for k, v in meta.items()},
+            "labels": labels,
+            "compression": compression,
+            "compression_level": self.compression_level,
+            "chunk_size": self.chunk_size,
+            "chunks": [],
         }
-        metafile["labels"]["filename"] = path.name
-        write_json_file(Path(upload_dir, "meta"), metafile)
+        return self.__stage_chunks(staging_dir, manifest)
+
+    def recover(self):
+        """
+        recover finishes staging uploads which were interrupted by a crash and cleans up the rest.
+
+        Complete staging dirs are renamed, chunked copies are resumed if their source file hasn't
+        changed and anything else is removed. Returns a list of (upload_dir, meta) for the
+        recovered uploads.
+        """
+        recovered = []
+        try:
+            paths = sorted(self.root.glob(".partial-*"))
+        except FileNotFoundError:
+            return recovered
+
+        for staging_dir in paths:
+            if staging_dir.suffix == ".lock":
+                remove_stale_lock_file(staging_dir)
+                continue
+            if not staging_dir.is_dir():
+                continue
+            lock = try_lock_staging_dir(staging_dir)
+            # staging dir is still being used by another uploader
+            if lock is None:
+                continue
+            try:
+                # staging dir was finished while we were acquiring the lock
+                if not staging_dir.exists():
+                    continue
+                result = self.__recover_staging_dir(staging_dir)
+            except Exception:
+                logger.exception("failed to recover upload %s", staging_dir)
+                shutil.rmtree(staging_dir, ignore_errors=True)
+                continue
+            finally:
+                release_staging_dir(staging_dir, lock)
+            if result is not None:
+                recovered.append(result)
+
+        return recovered
+
+    def __recover_staging_dir(self, staging_dir):
+        manifest = read_json_file(Path(staging_dir, "manifest"))
+        meta = read_json_file(Path(staging_dir, "meta"))
 
+        if meta is not None and Path(staging_dir, "data").exists():
+            logger.info("recovering staged upload %s", staging_dir)
+        elif manifest is not None and source_unchanged(manifest):
+            logger.info("resuming staging upload %s", staging_dir)
+            checksum = self.__stage_chunks(staging_dir, manifest)
+            write_meta_file(
+                staging_dir, manifest["timestamp"], checksum, manifest["labels"]
+            )
+            meta = read_json_file(Path(staging_dir, "meta"))
+        else:
+            logger.info("removing incomplete upload %s", staging_dir)
+            shutil.rmtree(staging_dir)
+            return None
+
+        upload_dir = self.__finish_staging_dir(
+            staging_dir, meta["timestamp"], meta["shasum"]
+        )
+        if manifest is not None and not manifest["keep"] and source_unchanged(manifest):
+            Path(manifest["source"]).unlink()
+        return upload_dir, meta
+
+    def __finish_staging_dir(self, staging_dir, timestamp, checksum):
+        try:
+            Path(staging_dir, "manifest").unlink()
+        except FileNotFoundError:
+            pass
+        upload_dir = Path(self.root, f"{timestamp}-{checksum}")
+        # an existing upload dir has the same timestamp and data, so we replace it
+        if upload_dir.exists():
+            shutil.rmtree(upload_dir)
+        os.rename(staging_dir, upload_dir)
         return upload_dir
 
+    def __stage_chunks(self, staging_dir, manifest):
+        # NOTE each chunk is compressed separately, as the compressor state can't be saved. this
+        # results in a multi-member gzip file or multi-frame zstd file. once a chunk is written, the
+        # data file is synced and the manifest is updated to include the chunk's size and checksum.
+        data_path = Path(staging_dir, "data")
+        manifest_path = Path(staging_dir, "manifest")
+        chunk_size = manifest["chunk_size"]
+        h = hashlib.sha1()
+
+        # hash existing chunks and drop any which were not completely written
+        chunks = []
+        data_path.touch()
+        with open(data_path, "rb", buffering=0) as f:
+            for chunk in manifest["chunks"]:
+                chunk_h = hashlib.sha1()
+                next_h = h.copy()
+                if not hash_file_range(f, chunk["size"], chunk_h, next_h):
+                    break
+                if chunk_h.hexdigest() != chunk["shasum"]:
+                    break
+                h = next_h
+                chunks.append(chunk)
+        manifest["chunks"] = chunks
+        write_json_file_atomic(manifest_path, manifest)
+
+        with open(manifest["source"], "rb", buffering=0) as fsrc, open(
+            data_path, "r+b", buffering=0
+        ) as fdst:
+            fsrc.seek(len(chunks) * chunk_size)
+            fdst.truncate(sum(chunk["size"] for chunk in chunks))
+            fdst.seek(0, os.SEEK_END)
+            buf = bytearray(min(COPY_BUFFER_SIZE, chunk_size))
+            view = memoryview(buf)
+
+            while True:
+                compressor = self.__new_compressor(
+                    manifest["compression"], manifest["compression_level"]
+                )
+                chunk_h = hashlib.sha1()
+                chunk_size_remaining = chunk_size
+                staged_size = 0
+                while chunk_size_remaining > 0:
+                    n = fsrc.readinto(view[:chunk_size_remaining])
+                    if n == 0:
+                        break
+                    chunk_size_remaining -= n
+                    data = view[:n]
+                    if compressor is not None:
+                        data = compressor.compress(data)
+                    h.update(data)
+                    chunk_h.update(data)
+                    write_all(fdst, data)
+                    staged_size += len(data)
+                if chunk_size_remaining == chunk_size:
+                    break
+                if compressor is not None:
+                    data = compressor.flush()
+                    h.update(data)
+                    chunk_h.update(data)
+                    write_all(fdst, data)
+                    staged_size += len(data)
+                os.fsync(fdst.fileno())
+                manifest["chunks"].append(
+                    {"size": staged_size, "shasum": chunk_h.hexdigest()}
+                )
+                write_json_file_atomic(manifest_path, manifest)
+
+        return h.hexdigest()
+
+    def __link_duplicate(self, source_checksum, compression, data_path):
+        # returns the checksum of the linked data or None if there's no usable duplicate.
+        name = self.dedup_index.get(source_checksum)
+        if name is None:
+            return None
+        # the existing upload may have been removed, staged with different compression or live on
+        # another filesystem, in which case we fall back to staging a new copy.
+        try:
+            existing_meta = json.loads(Path(self.root, name, "meta").read_text())
+            if existing_meta["labels"].get("compression") != compression:
+                return None
+            os.link(Path(self.root, name, "data"), data_path)
+        except (OSError, ValueError, KeyError):
+            return None
+        logger.debug("linked upload data to existing upload %s", name)
+        return existing_meta["shasum"]
+
+    def __compression_for_file(self, path):
+        if self.compression is None or is_compressed_file(path):
+            return None
+        return self.compression
+
+    def __new_compressor(self, compression, level):
+        if compression == "gzip":
+            if level is None:
+                level = zlib.Z_DEFAULT_COMPRESSION
+            # NOTE a wbits of 31 writes a gzip header with no filename and a zero mtime, so the
+            # compressed data and its checksum only depend on the file contents.
+            return zlib.compressobj(level, zlib.DEFLATED, 31)
+        if compression == "zstd":
+            # NOTE zstandard is an optional dependency, so we only import it when it's used.
+            import zstandard
+
+            if level is None:
+                level = 3
+            return zstandard.ZstdCompressor(level=level).compressobj()
+        return None
+
+
+class DedupIndex:
+    """
+    DedupIndex remembers the upload dir most recently staged for each checksum. Entries expire
+    after window seconds and are appended to a file at path, so the index survives restarts.
+    """
+
+    def __init__(self, path, window):
+        self.path = Path(path)
+        self.window = window
+        self.entries = {}
+        self.lines = 0
+        self.lock = Lock()
+        self.__load()
+
+    def __load(self):
+        try:
+            with open(self.path) as f:
+                for line in f:
+                    try:
+                        entry = json.loads(line)
+                        self.entries[entry["shasum"]] = (entry["name"], entry["time"])
+                    except (ValueError, KeyError, TypeError):
+                        # skip lines torn by a crash while appending
+                        continue
+                    self.lines += 1
+        except FileNotFoundError:
+            return
+        self.__expire(time())
+        try:
+            self.__compact()
+        except OSError as exc:
+            logger.error("failed to save upload dedup index: %s", exc)
+
+    def get(self, checksum):
+        with self.lock:
+            try:
+                name, added = self.entries[checksum]
+            except KeyError:
+                return None
+            if time() - added > self.window:
+                return None
+            return name
+
+    def add(self, checksum, name):
+        with self.lock:
+            now = time()
+            self.entries[checksum] = (name, now)
+            self.__expire(now)
+            # NOTE the index is only an optimization, so failing to save it only logs an error.
+            try:
+                if self.lines > 2 * len(self.entries) + 64:
+                    self.__compact()
+                else:
+                    with open(self.path, "a") as f:
+                        f.write(dump_dedup_entry(checksum, name, now))
+                    self.lines += 1
+            except OSError as exc:
+                logger.error("failed to save upload dedup index: %s", exc)
+
+    def __expire(self, now):
+        expired = [
+            k for k, (_, added) in self.entries.items() if now - added > self.window
+        ]
+        for k in expired:
+            del self.entries[k]
+
+    def __compact(self):
+        tmp_path = self.path.with_name(self.path.name + ".tmp")
+        with open(tmp_path, "w") as f:
+            for checksum, (name, added) in self.entries.items():
+                f.write(dump_dedup_entry(checksum, name, added))
+        os.replace(tmp_path, self.path)
+        self.lines = len(self.entries)
+
+
+def dump_dedup_entry(checksum, name, added):
+    return json.dumps({"shasum": checksum, "name": name, "time": added}) + "\n"
+
+
+class UploadPool:
+    """
+    UploadPool runs uploads on a bounded pool of worker threads so callers don't wait on disk I/O.
+
+    submit returns a Future for each upload. When max_pending_bytes is greater than zero, submit
+    blocks while the total size of pending uploads would exceed it. A single upload larger than
+    max_pending_bytes is still accepted once nothing else is pending.
+    """
+
+    def __init__(self, workers, max_pending_bytes=0):
+        if workers <= 0:
+            raise ValueError("upload pool workers must be positive")
+        self.executor = ThreadPoolExecutor(workers, thread_name_prefix="upload")
+        self.max_pending_bytes = max_pending_bytes
+        self.pending_bytes = 0
+        self.pending = set()
+        self.cond = Condition()
+
+    def __has_room_for(self, size):
+        return (
+            self.max_pending_bytes <= 0
+            or len(self.pending) == 0
+            or self.pending_bytes + size <= self.max_pending_bytes
+        )
+
+    def submit(self, size, fn, timeout=None):
+        with self.cond:
+            if not self.cond.wait_for(partial(self.__has_room_for, size), timeout):
+                raise TimeoutError("upload pool submit timed out")
+            future = self.executor.submit(fn)
+            self.pending.add(future)
+            self.pending_bytes += size
+        future.add_done_callback(partial(self.__done, size))
+        return future
+
+    def __done(self, size, future):
+        with self.cond:
+            self.pending.discard(future)
+            self.pending_bytes -= size
+            self.cond.notify_all()
+        if not future.cancelled() and future.exception() is not None:
+            logger.error("upload failed: %s", future.exception())
+
+    def flush(self, timeout=None) -> bool:
+        """
+        flush waits until all pending uploads are done and returns False if timeout expired first.
+        """
+        with self.cond:
+            return self.cond.wait_for(lambda: len(self.pending) == 0, timeout)
+
+    def metrics(self) -> dict:
+        with self.cond:
+            return {
+                "pending": len(self.pending),
+                "pending_bytes": self.pending_bytes,
+            }
+
+    def close(self):
+        self.executor.shutdown(wait=True)
+
+
+def create_staging_dir(root):
+    # NOTE the lock file is created and locked before the staging dir, so recover never sees an
+    # unlocked staging dir which is still in use.
+    fd, lock_path = tempfile.mkstemp(prefix=".partial-", suffix=".lock", dir=root)
+    lock = os.fdopen(fd, "w")
+    if fcntl is not None:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+    staging_dir = Path(lock_path[: -len(".lock")])
+    staging_dir.mkdir()
+    return staging_dir, lock
+
+
+def try_lock_staging_dir(staging_dir):
+    lock = open(lock_path_for_staging_dir(staging_dir), "a")
+    if fcntl is not None:
+        try:
+            fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            lock.close()
+            return None
+    return lock
+
+
+def release_staging_dir(staging_dir, lock):
+    try:
+        lock_path_for_staging_dir(staging_dir).unlink()
+    except FileNotFoundError:
+        pass
+    lock.close()
+
+
+def lock_path_for_staging_dir(staging_dir):
+    return Path(staging_dir).with_name(Path(staging_dir).name + ".lock")
+
+
+def remove_stale_lock_file(lock_path):
+    try:
+        if time() - lock_path.stat().st_mtime < STALE_LOCK_FILE_AGE:
+            return
+        if Path(str(lock_path)[: -len(".lock")]).exists():
+            return
+        lock_path.unlink()
+    except FileNotFoundError:
+        pass
+
+
+def source_unchanged(manifest):
+    try:
+        st = os.stat(manifest["source"])
+    except FileNotFoundError:
+        return False
+    return st.st_size == manifest["size"] and st.st_mtime_ns == manifest["mtime_ns"]
+
+
+def same_filesystem(path, root):
+    return os.stat(path).st_dev == os.stat(root).st_dev
+
+
+def move_file(src, dst):
+    # returns whether src was moved. rename can still fail across bind mounts of the same
+    # filesystem, in which case the caller must copy the file instead.
+    try:
+        os.rename(src, dst)
+    except OSError as exc:
+        if exc.errno == errno.EXDEV:
+            return False
+        raise
+    # match the permissions of a copied file, as the source may have been created private
+    os.chmod(dst, 0o644)
+    return True
+
 
 def sha1sum_for_file(path):
     h = hashlib.sha1()
-    with open(path, "rb") as f:
+    buf = bytearray(COPY_BUFFER_SIZE)
+    view = memoryview(buf)
+    with open(path, "rb", buffering=0) as f:
+        while True:
+            n = f.readinto(buf)
+            if n == 0:
+                break
+            h.update(view[:n])
+    return h.hexdigest()
+
+
+def copy_file_with_sha1sum(src, dst, compressor=None):
+    # NOTE we hash while copying so the source is only read once. zero-copy methods like
+    # copy_file_range or sendfile can't be used here as the data must pass through the hash.
+    # when a compressor is provided, the data is compressed in the same pass and the checksum is
+    # of the compressed data written to dst.
+    h = hashlib.sha1()
+    buf = bytearray(COPY_BUFFER_SIZE)
+    view = memoryview(buf)
+    with open(src, "rb", buffering=0) as fsrc, open(dst, "wb", buffering=0) as fdst:
         while True:
-            chunk = f.read(32768)
-            if chunk == b"":
+            n = fsrc.readinto(buf)
+            if n == 0:
                 break
+            chunk = view[:n]
+            if compressor is not None:
+                chunk = compressor.compress(chunk)
             h.update(chunk)
+            write_all(fdst, chunk)
+        if compressor is not None:
+            chunk = compressor.flush()
+            h.update(chunk)
+            write_all(fdst, chunk)
     return h.hexdigest()
 
 
+def hash_file_range(f, size, *hashes):
+    # returns False if the file ends before size bytes are read
+    buf = bytearray(min(COPY_BUFFER_SIZE, max(size, 1)))
+    view = memoryview(buf)
+    while size > 0:
+        n = f.readinto(view[:size])
+        if n == 0:
+            return False
+        for h in hashes:
+            h.update(view[:n])
+        size -= n
+    return True
+
+
+def write_all(f, data):
+    # raw writes may be partial, so we write until all the data is written
+    view = memoryview(data)
+    while len(view) > 0:
+        view = view[f.write(view) :]
+
+
+def is_compressed_file(path):
+    if Path(path).suffix.lower() in COMPRESSED_EXTENSIONS:
+        return True
+    with open(path, "rb") as f:
+        head = f.read(12)
+    return (
+        head.startswith(COMPRESSED_MAGIC_BYTES)
+        # mp4, mov and heic
+        or head[4:8] == b"ftyp"
+        # webp
+        or (head[:4] == b"RIFF" and head[8:12] == b"WEBP")
+    )
+
+
+def write_meta_file(staging_dir, timestamp, checksum, labels):
+    metafile = {
+        "timestamp": timestamp,
+        "shasum": checksum,
+        "labels": labels,
+    }
+    write_json_file(Path(staging_dir, "meta"), metafile)
+
+
+def read_json_file(path):
+    try:
+        return json.loads(Path(path).read_text())
+    except (FileNotFoundError, ValueError):
+        return None
+
+
 def write_json_file(path, obj):
     with open(path, "w") as f:
         json.dump(obj, f, separators=(",", ":"), sort_keys=True)
+
+
+def write_json_file_atomic(path, obj):
+    tmp_path = Path(path).with_name(Path(path).name + ".tmp")
+    write_json_file(tmp_path, obj)
+    os.replace(tmp_path, path)
@@ -1,14 +1,43 @@
 import unittest
 from pathlib import Path
+import gzip
+import hashlib
 import json
 from tempfile import TemporaryDirectory
 import time
 from datetime import datetime
 import os
 import pika
+import shutil
 import subprocess
+import asyncio
+import sys
 
-from waggle.plugin import Plugin, PluginConfig, Uploader, get_timestamp
+from waggle.plugin import AsyncPlugin, Plugin, PluginConfig, Uploader, get_timestamp
+from waggle.plugin.plugin import (
+    FilesystemPublisher,
+    isoformat_time_ns,
+    raise_for_invalid_publish_name,
+    valid_publish_names,
+)
+from waggle.plugin.outbox import Outbox
+from waggle.plugin.queue import MessageQueue
+from waggle.plugin import uploader as uploader_module
+from waggle.plugin.uploader import (
+    UploadPool,
+    release_staging_dir,
+    try_lock_staging_dir,
+)
+from unittest.mock import patch
+from threading import Event, Thread
+from waggle.plugin.rabbitmq import (
+    PublishData,
+    PublisherMetrics,
+    RetryBuffer,
+    get_batch,
+    get_publish_properties,
+)
+from queue import Queue, Empty
 import wagglemsg
 
 # TODO(sean) add integration testing against rabbitmq
@@ -130,6 +159,26 @@ class TestPlugin(unittest.TestCase):
             # correct alternative
             plugin.publish("sys.cpu_temp", 0)
 
+    def test_publish_name_cache(self):
+        valid_publish_names.clear()
+        raise_for_invalid_publish_name("env.temperature")
+        self.assertIn("env.temperature", valid_publish_names)
+        raise_for_invalid_publish_name("env.temperature")
+
+        for name in ["env..temperature", "env.temperature\n", "upload", "Env"]:
+            with self.assertRaises(ValueError):
+                raise_for_invalid_publish_name(name)
+            self.assertNotIn(name, valid_publish_names)
+
+        with self.assertRaises(TypeError):
+            raise_for_invalid_publish_name(["env.temperature"])
+
+    def test_timeit_checks_name(self):
+        with Plugin() as plugin:
+            with self.assertRaises(ValueError):
+                with plugin.timeit("my-duration"):
+                    self.fail("timeit block should not run with invalid name")
+
     # TODO(sean) refactor messaging part to make testing this cleaner
     def test_upload_file(self):
         with TemporaryDirectory() as tempdir:
@@ -158,6 +207,37 @@ class TestPlugin(unittest.TestCase):
             self.assertIsNotNone(msg.meta)
             self.assertIn("filename", msg.meta)
 
+    def test_upload_file_background(self):
+        with TemporaryDirectory() as tempdir:
+            config = PluginConfig(
+                host="fake-rabbitmq-host",
+                port=5672,
+                username="plugin",
+                password="plugin",
+                app_id="",
+                upload_workers=2,
+            )
+            uploader = Uploader(Path(tempdir, "uploads"))
+
+            with Plugin(config, uploader=uploader) as plugin:
+                futures = []
+                for i in range(4):
+                    upload_path = Path(tempdir, f"file{i}.txt")
+                    upload_path.write_bytes(f"data {i}".encode())
+                    futures.append(plugin.upload_file(upload_path))
+                plugin.flush(timeout=5)
+                self.assertEqual(plugin.metrics()["uploads"]["pending"], 0)
+
+                for i, future in enumerate(futures):
+                    path = future.result(timeout=0)
+                    self.assertEqual(
+                        Path(path, "data").read_bytes(), f"data {i}".encode()
+                    )
+                    self.assertFalse(Path(tempdir, f"file{i}.txt").exists())
+
+                # upload messages are published once staged
+                self.assertEqual(plugin.metrics()["send_queue"]["enqueued"], 4)
+
     def test_timeit(self):
         with Plugin() as plugin:
             with plugin.timeit("dur"):
@@ -171,6 +251,445 @@ class TestPlugin(unittest.TestCase):
         with self.assertRaises(RuntimeError) as cm:
             plugin.publish("test", "value")
 
+    def test_publish_many(self):
+        with Plugin() as plugin:
+            plugin.publish_many(
+                [
+                    ("test.int", 1),
+                    ("test.float", 2.0, {"camera": "left"}),
+                    ("test.str", "three", None, 1649694687904754000),
+                ],
+                meta={"camera": "right"},
+                timestamp=1649694687904753000,
+            )
+            item = plugin.send.get_nowait()
+            self.assertEqual(item.scope, "all")
+            self.assertEqual(
+                item.bodies,
+                [
+                    wagglemsg.dump(
+                        wagglemsg.Message(
+                            "test.int", 1, 1649694687904753000, {"camera": "right"}
+                        )
+                    ),
+                    wagglemsg.dump(
+                        wagglemsg.Message(
+                            "test.float", 2.0, 1649694687904753000, {"camera": "left"}
+                        )
+                    ),
+                    wagglemsg.dump(
+                        wagglemsg.Message(
+                            "test.str",
+                            "three",
+                            1649694687904754000,
+                            {"camera": "right"},
+                        )
+                    ),
+                ],
+            )
+
+    def test_publish_many_columns(self):
+        with Plugin() as plugin:
+            plugin.publish_many(
+                {
+                    "name": "vision.object.confidence",
+                    "value": [0.9, 0.8],
+                    "meta": [{"label": "car"}, {"label": "bird"}],
+                },
+                timestamp=1649694687904754000,
+            )
+            item = plugin.send.get_nowait()
+            msgs = [wagglemsg.load(body) for body in item.bodies]
+            self.assertEqual([msg.value for msg in msgs], [0.9, 0.8])
+            self.assertEqual([msg.meta["label"] for msg in msgs], ["car", "bird"])
+            self.assertEqual(msgs[0].name, "vision.object.confidence")
+
+            # empty publishes are ignored
+            plugin.publish_many([])
+            with self.assertRaises(Empty):
+                plugin.send.get_nowait()
+
+            with self.assertRaises(ValueError):
+                plugin.publish_many({"name": ["a", "b"], "value": [1]})
+
+    def test_publish_many_validation(self):
+        with Plugin() as plugin:
+            with self.assertRaises(ValueError):
+                plugin.publish_many([("test", 1), ("upload", "path/to/data")])
+            with self.assertRaises(TypeError):
+                plugin.publish_many([("test", 1), ("test", [1, 2, 3])])
+            with self.assertRaises(TypeError):
+                plugin.publish_many([("test", 1), ("test", 1, {"k": 10})])
+            with self.assertRaises(ValueError):
+                plugin.publish_many([("test", 1), ("test", 1, None, 1649694687)])
+            # nothing is published when any record is invalid
+            with self.assertRaises(Empty):
+                plugin.send.get_nowait()
+
+    def test_exit_is_fast(self):
+        config = PluginConfig(
+            username="plugin",
+            password="plugin",
+            host="127.0.0.1",
+            port=1,
+            app_id="",
+        )
+        plugin = Plugin(config)
+        with plugin:
+            plugin.subscribe("test")
+            time.sleep(0.1)
+            start = time.monotonic()
+        self.assertLess(time.monotonic() - start, 0.5)
+
+    def test_metrics(self):
+        with Plugin() as plugin:
+            metrics = plugin.metrics()
+            self.assertEqual(metrics["publisher"]["messages_published"], 0)
+            self.assertEqual(metrics["publisher"]["messages_per_second"], 0.0)
+
+
+def zstandard_available():
+    try:
+        import zstandard
+    except ImportError:
+        return False
+    return True
+
+
+def aio_pika_available():
+    try:
+        import aio_pika
+    except ImportError:
+        return False
+    return sys.version_info >= (3, 7)
+
+
+@unittest.skipUnless(aio_pika_available(), "aio_pika not available")
+class TestAsyncPlugin(unittest.TestCase):
+    def setUp(self):
+        self.config = PluginConfig(
+            username="plugin",
+            password="plugin",
+            host="127.0.0.1",
+            port=1,
+            app_id="",
+        )
+
+    def test_publish(self):
+        async def main():
+            async with AsyncPlugin(self.config) as plugin:
+                await plugin.publish("test.int", 1)
+                await plugin.publish("test.str", "three", meta={"camera": "left"})
+                item = plugin.send.get_nowait()
+                self.assertEqual(item.scope, "all")
+                msg = wagglemsg.load(item.body)
+                self.assertEqual(msg.name, "test.int")
+                self.assertEqual(msg.value, 1)
+
+        asyncio.run(main())
+
+    def test_validation(self):
+        async def main():
+            async with AsyncPlugin(self.config) as plugin:
+                with self.assertRaises(ValueError):
+                    await plugin.publish("upload", "path/to/data")
+                with self.assertRaises(ValueError):
+                    await plugin.publish("my-metric", 0)
+                with self.assertRaises(TypeError):
+                    await plugin.publish("test", [1, 2, 3])
+                with self.assertRaises(TypeError):
+                    await plugin.publish("test", 1, meta={"k": 10})
+                with self.assertRaises(ValueError):
+                    await plugin.publish("test", 1, timestamp=1649694687)
+
+        asyncio.run(main())
+
+    def test_get(self):
+        async def main():
+            async with AsyncPlugin(self.config) as plugin:
+                messages = plugin.subscribe("raw.#")
+                with self.assertRaises(TimeoutError):
+                    await plugin.get(timeout=0)
+                msg = wagglemsg.Message("test", 1.0, 0, {})
+                plugin.recv.put_nowait(msg)
+                self.assertEqual(await plugin.get(timeout=0), msg)
+                plugin.recv.put_nowait(msg)
+                self.assertEqual(await messages.__anext__(), msg)
+
+        asyncio.run(main())
+
+    def test_timeit(self):
+        async def main():
+            async with AsyncPlugin(self.config) as plugin:
+                async with plugin.timeit("dur"):
+                    await asyncio.sleep(0.001)
+                msg = wagglemsg.load(plugin.send.get_nowait().body)
+                self.assertEqual(msg.name, "dur")
+
+        asyncio.run(main())
+
+    def test_must_be_in_with(self):
+        async def main():
+            plugin = AsyncPlugin(self.config)
+            with self.assertRaises(RuntimeError):
+                await plugin.publish("test", "value")
+
+        asyncio.run(main())
+
+
+class TestMessageQueue(unittest.TestCase):
+    def test_close_wakes_get(self):
+        q = MessageQueue()
+        errors = []
+
+        def get():
+            try:
+                q.get(timeout=10)
+            except Empty as exc:
+                errors.append(exc)
+
+        t = Thread(target=get)
+        start = time.monotonic()
+        t.start()
+        time.sleep(0.01)
+        q.close()
+        t.join()
+        self.assertLess(time.monotonic() - start, 1.0)
+        self.assertEqual(len(errors), 1)
+
+    def test_drop_policies(self):
+        q = MessageQueue(3, "drop_newest")
+        for i in range(5):
+            q.put(i)
+        self.assertEqual([q.get_nowait() for _ in range(3)], [0, 1, 2])
+
+        q = MessageQueue(3, "drop_oldest")
+        for i in range(5):
+            q.put(i)
+        self.assertEqual([q.get_nowait() for _ in range(3)], [2, 3, 4])
+        metrics = q.metrics()
+        self.assertEqual(metrics["depth"], 0)
+        self.assertEqual(metrics["high_water"], 3)
+        self.assertEqual(metrics["enqueued"], 5)
+        self.assertEqual(metrics["dropped"], 2)
+
+        q = MessageQueue(2, "sample", sample_interval=3)
+        for i in range(8):
+            q.put(i)
+        # 2 through 7 arrive while full and only every third of them is kept
+        self.assertEqual([q.get_nowait() for _ in range(2)], [4, 7])
+        self.assertEqual(q.metrics()["dropped"], 6)
+
+        with self.assertRaises(ValueError):
+            MessageQueue(3, "drop_random")
+
+    def test_publish_timeout(self):
+        config = PluginConfig(
+            username="plugin",
+            password="plugin",
+            host="127.0.0.1",
+            port=1,
+            app_id="",
+            send_queue_size=1,
+            # keep the publisher from draining the queue while disconnected
+            publish_retry_buffer_size=1,
+        )
+        with Plugin(config) as plugin:
+            plugin.publish("test", 1)
+            # wait for the publisher to fill its retry buffer
+            time.sleep(0.2)
+            plugin.publish("test", 2, timeout=0.1)
+            with self.assertRaises(TimeoutError):
+                plugin.publish("test", 3, timeout=0.1)
+            self.assertEqual(plugin.metrics()["send_queue"]["high_water"], 1)
+
+    def test_get_after_close(self):
+        q = MessageQueue()
+        q.put(1)
+        q.close()
+        self.assertEqual(q.get(timeout=10), 1)
+        with self.assertRaises(Empty):
+            q.get()
+
+
+class TestPublisher(unittest.TestCase):
+    def test_get_publish_properties(self):
+        config = PluginConfig(
+            username="plugin",
+            password="plugin",
+            host="rabbitmq",
+            port=5672,
+            app_id="",
+        )
+        properties = get_publish_properties(config)
+        self.assertEqual(properties.delivery_mode, 2)
+        self.assertEqual(properties.user_id, "plugin")
+        self.assertIsNone(properties.app_id)
+
+        config = config._replace(app_id="0668b12c-0c15-462c-9e06-7239282411e5")
+        properties = get_publish_properties(config)
+        self.assertEqual(properties.app_id, "0668b12c-0c15-462c-9e06-7239282411e5")
+
+    def test_get_batch(self):
+        q = Queue()
+        for i in range(10):
+            q.put(i)
+        self.assertEqual(get_batch(q, 4, 0.0), [0, 1, 2, 3])
+        self.assertEqual(get_batch(q, 4, 0.01), [4, 5, 6, 7])
+        self.assertEqual(get_batch(q, 4, 0.01), [8, 9])
+        with self.assertRaises(Empty):
+            get_batch(q, 4, 0.01)
+
+    def test_metrics(self):
+        metrics = PublisherMetrics()
+        metrics.record_published(10)
+        metrics.record_confirm(0.002)
+        metrics.record_confirm(0.004)
+        snapshot = metrics.snapshot()
+        self.assertEqual(snapshot["messages_published"], 10)
+        self.assertEqual(snapshot["batches_confirmed"], 2)
+        self.assertAlmostEqual(snapshot["confirm_latency_last"], 0.004)
+        self.assertAlmostEqual(snapshot["confirm_latency_mean"], 0.003)
+
+
+def make_publish_items(n):
+    return [PublishData("all", f"message {i}".encode()) for i in range(n)]
+
+
+class TestRetryBuffer(unittest.TestCase):
+    def test_preserves_order(self):
+        items = make_publish_items(5)
+        buffer = RetryBuffer(10)
+        buffer.extend(items)
+        # simulate a failed publish followed by a replay
+        self.assertEqual(buffer.peek(2), items[:2])
+        self.assertEqual(buffer.peek(2), items[:2])
+        buffer.ack(2)
+        self.assertEqual(buffer.peek(10), items[2:])
+
+    def test_block(self):
+        buffer = RetryBuffer(3, "block")
+        buffer.extend(make_publish_items(2))
+        self.assertFalse(buffer.full())
+        buffer.extend(make_publish_items(1))
+        self.assertTrue(buffer.full())
+
+    def test_drop_oldest(self):
+        items = make_publish_items(5)
+        buffer = RetryBuffer(3, "drop_oldest")
+        buffer.extend(items)
+        self.assertFalse(buffer.full())
+        self.assertEqual(buffer.dropped, 2)
+        self.assertEqual(buffer.peek(10), items[2:])
+
+    def test_spill(self):
+        items = make_publish_items(10)
+        with TemporaryDirectory() as tempdir:
+            buffer = RetryBuffer(3, "spill", tempdir)
+            buffer.extend(items[:6])
+            self.assertEqual(len(buffer), 6)
+            buffer.ack(len(buffer.peek(2)))
+            # newer messages must go behind the spilled ones
+            buffer.extend(items[6:])
+            replayed = []
+            while len(buffer) > 0:
+                batch = buffer.peek(2)
+                replayed.extend(batch)
+                buffer.ack(len(batch))
+            buffer.close()
+        self.assertEqual(replayed, items[2:])
+
+    def test_invalid_policy(self):
+        with self.assertRaises(ValueError):
+            RetryBuffer(10, "requeue")
+        with self.assertRaises(ValueError):
+            RetryBuffer(10, "spill")
+
+
+class TestOutbox(unittest.TestCase):
+    def test_peek_ack(self):
+        records = [f"record {i}".encode() for i in range(10)]
+        with TemporaryDirectory() as tempdir:
+            outbox = Outbox(tempdir)
+            outbox.extend(records[:5])
+            outbox.append(records[5])
+            self.assertEqual(len(outbox), 6)
+            self.assertEqual(outbox.peek(3), records[:3])
+            self.assertEqual(outbox.peek(3), records[:3])
+            outbox.ack(3)
+            outbox.extend(records[6:])
+            self.assertEqual(outbox.peek(100), records[3:])
+            outbox.ack(7)
+            self.assertEqual(len(outbox), 0)
+            self.assertEqual(outbox.peek(100), [])
+            outbox.close()
+
+    def test_rotate_and_reopen(self):
+        records = [f"record {i}".encode() for i in range(100)]
+        with TemporaryDirectory() as tempdir:
+            outbox = Outbox(tempdir, segment_size=64)
+            outbox.extend(records)
+            outbox.ack(40)
+            outbox.close()
+            self.assertGreater(len(list(Path(tempdir).glob("*.seg"))), 1)
+
+            outbox = Outbox(tempdir, segment_size=64)
+            self.assertEqual(len(outbox), 60)
+            self.assertEqual(outbox.peek(100), records[40:])
+            outbox.ack(60)
+            outbox.close()
+            self.assertEqual(len(list(Path(tempdir).glob("*.seg"))), 1)
+
+    def test_torn_record(self):
+        records = [f"record {i}".encode() for i in range(3)]
+        with TemporaryDirectory() as tempdir:
+            outbox = Outbox(tempdir)
+            outbox.extend(records)
+            outbox.close()
+
+            # simulate a crash while writing the last record
+            segment = next(Path(tempdir).glob("*.seg"))
+            segment.write_bytes(segment.read_bytes()[:-3])
+
+            outbox = Outbox(tempdir)
+            self.assertEqual(outbox.peek(100), records[:2])
+            outbox.append(records[2])
+            self.assertEqual(outbox.peek(100), records)
+            outbox.close()
+
+
+class TestUploadPool(unittest.TestCase):
+    def test_max_pending_bytes(self):
+        pool = UploadPool(2, max_pending_bytes=10)
+        release = Event()
+        first = pool.submit(8, release.wait)
+
+        # second upload would exceed max pending bytes while first is pending
+        with self.assertRaises(TimeoutError):
+            pool.submit(8, lambda: None, timeout=0.05)
+        self.assertFalse(pool.flush(timeout=0.01))
+        self.assertEqual(pool.metrics(), {"pending": 1, "pending_bytes": 8})
+
+        release.set()
+        self.assertTrue(first.result(timeout=1))
+        # uploads larger than max pending bytes are accepted once nothing is pending
+        self.assertEqual(pool.submit(100, lambda: 1).result(timeout=1), 1)
+        self.assertTrue(pool.flush(timeout=1))
+        self.assertEqual(pool.metrics(), {"pending": 0, "pending_bytes": 0})
+        pool.close()
+
+    def test_error(self):
+        pool = UploadPool(1)
+
+        def fail():
+            raise OSError("disk full")
+
+        with self.assertLogs("waggle.plugin.uploader", "ERROR"):
+            future = pool.submit(1, fail)
+            with self.assertRaises(OSError):
+                future.result(timeout=1)
+            pool.close()
+
 
 class TestUploader(unittest.TestCase):
     def test_upload_file(self):
@@ -191,6 +710,289 @@ class TestUploader(unittest.TestCase):
             self.assertIn("shasum", meta)
             self.assertEqual(meta["labels"]["filename"], upload_path.name)
 
+    def test_upload_file_keep(self):
+        with TemporaryDirectory() as tempdir:
+            uploader = Uploader(Path(tempdir, "uploads"))
+
+            # use data larger than the copy buffer to check chunks are all hashed and copied
+            data = os.urandom(3 * 1024 * 1024 + 123)
+
+            upload_path = Path(tempdir, "myfile.bin")
+            upload_path.write_bytes(data)
+
+            path = uploader.upload_file(upload_path, keep=True)
+            self.assertEqual(data, upload_path.read_bytes())
+
+            self.assertEqual(data, Path(path, "data").read_bytes())
+            meta = json.loads(Path(path, "meta").read_text())
+            self.assertEqual(meta["shasum"], hashlib.sha1(data).hexdigest())
+            self.assertTrue(path.name.endswith(meta["shasum"]))
+
+    def test_upload_file_dedup(self):
+        with TemporaryDirectory() as tempdir:
+            uploader = Uploader(Path(tempdir, "uploads"), dedup_window=60)
+            data = b"the same snapshot"
+
+            paths = []
+            for i in range(3):
+                upload_path = Path(tempdir, f"snapshot{i}.jpg")
+                upload_path.write_bytes(data)
+                paths.append(
+                    uploader.upload_file(upload_path, meta={"i": str(i)}, timestamp=i + 1)
+                )
+                self.assertFalse(upload_path.exists())
+
+            # each upload has its own meta but shares the staged data
+            for i, path in enumerate(paths):
+                meta = json.loads(Path(path, "meta").read_text())
+                self.assertEqual(meta["timestamp"], i + 1)
+                self.assertEqual(meta["labels"]["i"], str(i))
+                self.assertEqual(meta["labels"]["filename"], f"snapshot{i}.jpg")
+                self.assertEqual(meta["shasum"], hashlib.sha1(data).hexdigest())
+                self.assertEqual(Path(path, "data").read_bytes(), data)
+            self.assertEqual(Path(paths[0], "data").stat().st_nlink, 3)
+
+            # index is reloaded on restart and falls back to copying if uploads were removed
+            for path in paths:
+                shutil.rmtree(path)
+            uploader = Uploader(Path(tempdir, "uploads"), dedup_window=60)
+            self.assertEqual(uploader.dedup_index.get(meta["shasum"]), paths[-1].name)
+            upload_path = Path(tempdir, "snapshot.jpg")
+            upload_path.write_bytes(data)
+            path = uploader.upload_file(upload_path, keep=True)
+            self.assertEqual(Path(path, "data").read_bytes(), data)
+            self.assertEqual(Path(path, "data").stat().st_nlink, 1)
+
+    def test_upload_file_dedup_window(self):
+        with TemporaryDirectory() as tempdir:
+            uploader = Uploader(Path(tempdir, "uploads"), dedup_window=0.05)
+            upload_path = Path(tempdir, "snapshot.jpg")
+            upload_path.write_bytes(b"data")
+            path1 = uploader.upload_file(upload_path, timestamp=1, keep=True)
+            time.sleep(0.1)
+            path2 = uploader.upload_file(upload_path, timestamp=2, keep=True)
+            self.assertEqual(Path(path1, "data").stat().st_nlink, 1)
+            self.assertEqual(Path(path2, "data").stat().st_nlink, 1)
+
+    def test_upload_file_gzip(self):
+        with TemporaryDirectory() as tempdir:
+            uploader = Uploader(Path(tempdir, "uploads"), compression="gzip")
+            data = b"a very compressible recording " * 100000
+
+            paths = []
+            for i in range(2):
+                upload_path = Path(tempdir, "recording.wav")
+                upload_path.write_bytes(data)
+                paths.append(uploader.upload_file(upload_path, timestamp=i + 1))
+                self.assertFalse(upload_path.exists())
+
+            for path in paths:
+                compressed = Path(path, "data").read_bytes()
+                self.assertLess(len(compressed), len(data))
+                self.assertEqual(gzip.decompress(compressed), data)
+                meta = json.loads(Path(path, "meta").read_text())
+                self.assertEqual(meta["labels"]["compression"], "gzip")
+                self.assertEqual(meta["labels"]["filename"], "recording.wav")
+                self.assertEqual(meta["shasum"], hashlib.sha1(compressed).hexdigest())
+
+            # compressed output only depends on the contents
+            self.assertEqual(
+                Path(paths[0], "data").read_bytes(), Path(paths[1], "data").read_bytes()
+            )
+
+    def test_upload_file_skip_compressed(self):
+        with TemporaryDirectory() as tempdir:
+            uploader = Uploader(Path(tempdir, "uploads"), compression="gzip")
+            testcases = {
+                "image.jpg": b"not really a jpeg",
+                "data.bin": gzip.compress(b"gzip data with unknown extension"),
+            }
+            for name, data in testcases.items():
+                upload_path = Path(tempdir, name)
+                upload_path.write_bytes(data)
+                path = uploader.upload_file(upload_path)
+                self.assertEqual(Path(path, "data").read_bytes(), data)
+                meta = json.loads(Path(path, "meta").read_text())
+                self.assertNotIn("compression", meta["labels"])
+
+    def test_upload_file_compression_dedup(self):
+        with TemporaryDirectory() as tempdir:
+            data = b"the same compressible snapshot " * 1000
+            upload_path = Path(tempdir, "snapshot.npy")
+            upload_path.write_bytes(data)
+
+            uploader = Uploader(Path(tempdir, "uploads"), dedup_window=60)
+            path1 = uploader.upload_file(upload_path, timestamp=1, keep=True)
+
+            # data staged without compression is not reused when compressing
+            uploader = Uploader(
+                Path(tempdir, "uploads"), dedup_window=60, compression="gzip"
+            )
+            path2 = uploader.upload_file(upload_path, timestamp=2, keep=True)
+            path3 = uploader.upload_file(upload_path, timestamp=3, keep=True)
+            self.assertEqual(Path(path1, "data").stat().st_nlink, 1)
+            self.assertEqual(Path(path2, "data").stat().st_nlink, 2)
+            self.assertEqual(gzip.decompress(Path(path3, "data").read_bytes()), data)
+            meta2 = json.loads(Path(path2, "meta").read_text())
+            meta3 = json.loads(Path(path3, "meta").read_text())
+            self.assertEqual(meta2["shasum"], meta3["shasum"])
+            self.assertEqual(meta3["labels"]["compression"], "gzip")
+
+    @unittest.skipUnless(zstandard_available(), "zstandard not available")
+    def test_upload_file_zstd(self):
+        import zstandard
+
+        with TemporaryDirectory() as tempdir:
+            uploader = Uploader(
+                Path(tempdir, "uploads"), compression="zstd", compression_level=10
+            )
+            data = b"a very compressible recording " * 100000
+            upload_path = Path(tempdir, "recording.wav")
+            upload_path.write_bytes(data)
+            path = uploader.upload_file(upload_path)
+            compressed = Path(path, "data").read_bytes()
+            self.assertEqual(
+                zstandard.ZstdDecompressor().decompressobj().decompress(compressed),
+                data,
+            )
+            meta = json.loads(Path(path, "meta").read_text())
+            self.assertEqual(meta["labels"]["compression"], "zstd")
+
+    def test_upload_file_invalid_compression(self):
+        with self.assertRaises(ValueError):
+            Uploader("uploads", compression="lz4")
+
+    def test_upload_file_chunked(self):
+        with TemporaryDirectory() as tempdir:
+            uploader = Uploader(Path(tempdir, "uploads"), chunk_size=1000)
+            data = os.urandom(3500)
+            upload_path = Path(tempdir, "recording.wav")
+            upload_path.write_bytes(data)
+            path = uploader.upload_file(upload_path, keep=True)
+            self.assertEqual(sorted(p.name for p in path.iterdir()), ["data", "meta"])
+            self.assertEqual(Path(path, "data").read_bytes(), data)
+            meta = json.loads(Path(path, "meta").read_text())
+            self.assertEqual(meta["shasum"], hashlib.sha1(data).hexdigest())
+
+    def crash_while_uploading(self, uploader, path, chunks, **kwargs):
+        # fork and exit the child while it's staging the given chunk to simulate a crash
+        pid = os.fork()
+        if pid == 0:
+            try:
+                calls = 0
+
+                def write_json_file_atomic(path, obj):
+                    nonlocal calls
+                    calls += 1
+                    if calls > chunks:
+                        os._exit(0)
+                    uploader_module.write_json_file_atomic(path, obj)
+
+                with patch(
+                    "waggle.plugin.uploader.write_json_file_atomic",
+                    write_json_file_atomic,
+                ):
+                    uploader.upload_file(path, **kwargs)
+            finally:
+                os._exit(1)
+        _, status = os.waitpid(pid, 0)
+        self.assertEqual(os.WEXITSTATUS(status), 0)
+
+    def test_recover_chunked(self):
+        for compression in [None, "gzip"]:
+            with TemporaryDirectory() as tempdir:
+                uploader = Uploader(
+                    Path(tempdir, "uploads"), compression=compression, chunk_size=1000
+                )
+                data = b"some recorded data " * 500
+                upload_path = Path(tempdir, "recording.wav")
+                upload_path.write_bytes(data)
+
+                # stage the first chunk and crash after writing half of the second one
+                self.crash_while_uploading(
+                    uploader, upload_path, 2, meta={"k": "v"}, timestamp=123
+                )
+                staging_dir = next(uploader.root.glob(".partial-*[!k]"))
+                with open(Path(staging_dir, "data"), "ab") as f:
+                    f.write(b"torn")
+                self.assertTrue(upload_path.exists())
+
+                recovered = Uploader(uploader.root).recover()
+                self.assertEqual(len(recovered), 1)
+                path, meta = recovered[0]
+                self.assertEqual(list(uploader.root.iterdir()), [path])
+                self.assertFalse(upload_path.exists())
+
+                staged = Path(path, "data").read_bytes()
+                if compression == "gzip":
+                    staged = gzip.decompress(staged)
+                self.assertEqual(staged, data)
+                self.assertEqual(
+                    meta["shasum"],
+                    hashlib.sha1(Path(path, "data").read_bytes()).hexdigest(),
+                )
+                self.assertEqual(meta["timestamp"], 123)
+                self.assertEqual(meta["labels"]["k"], "v")
+                self.assertEqual(path.name, f"123-{meta['shasum']}")
+
+    def test_recover_cleanup(self):
+        with TemporaryDirectory() as tempdir:
+            uploader = Uploader(Path(tempdir, "uploads"), chunk_size=1000)
+            upload_path = Path(tempdir, "recording.wav")
+            upload_path.write_bytes(os.urandom(5000))
+            self.crash_while_uploading(uploader, upload_path, 2, keep=True)
+
+            # partial uploads are removed if the source changed since they were started
+            upload_path.write_bytes(os.urandom(5000))
+            # partial uploads without a manifest can't be resumed
+            Path(uploader.root, ".partial-copy").mkdir()
+            Path(uploader.root, ".partial-copy", "data").write_bytes(b"partial")
+
+            self.assertEqual(uploader.recover(), [])
+            self.assertEqual(list(uploader.root.iterdir()), [])
+
+    def test_recover_complete(self):
+        with TemporaryDirectory() as tempdir:
+            uploader = Uploader(Path(tempdir, "uploads"))
+            uploader.root.mkdir()
+            staging_dir = Path(uploader.root, ".partial-moved")
+            staging_dir.mkdir()
+            Path(staging_dir, "data").write_bytes(b"data")
+            meta = {"timestamp": 123, "shasum": "abc", "labels": {"filename": "f"}}
+            Path(staging_dir, "meta").write_text(json.dumps(meta))
+
+            # staging dirs in use are skipped
+            lock = try_lock_staging_dir(staging_dir)
+            self.assertEqual(uploader.recover(), [])
+            self.assertTrue(staging_dir.exists())
+            release_staging_dir(staging_dir, lock)
+
+            self.assertEqual(
+                uploader.recover(), [(Path(uploader.root, "123-abc"), meta)]
+            )
+            self.assertEqual(Path(uploader.root, "123-abc", "data").read_bytes(), b"data")
+
+            # plugin publishes recovered uploads on start
+            staging_dir.mkdir()
+            Path(staging_dir, "data").write_bytes(b"data")
+            Path(staging_dir, "meta").write_text(json.dumps(meta))
+            with Plugin(uploader=uploader) as plugin:
+                self.assertEqual(plugin.metrics()["send_queue"]["enqueued"], 1)
+
+    def test_upload_file_no_partial_dirs(self):
+        with TemporaryDirectory() as tempdir:
+            uploader = Uploader(Path(tempdir, "uploads"))
+
+            upload_path = Path(tempdir, "myfile.txt")
+            upload_path.write_bytes(b"data")
+            path = uploader.upload_file(upload_path)
+            self.assertEqual(list(uploader.root.iterdir()), [path])
+
+            # failed uploads should not leave behind staging dirs
+            with self.assertRaises(FileNotFoundError):
+                uploader.upload_file(Path(tempdir, "missing.txt"))
+            self.assertEqual(list(uploader.root.iterdir()), [path])
+
 
 def rabbitmq_available():
     try:
@@ -257,6 +1059,63 @@ class TestPluginWithRabbitMQ(unittest.TestCase):
             self.assertEqual(msg, msg2)
 
 
+def isoformat_time_ns_reference(ns: int) -> str:
+    nanostr = f"{ns%1000:03d}"
+    return datetime.fromtimestamp(ns / 1e9).isoformat() + nanostr
+
+
+class TestFilesystemPublisher(unittest.TestCase):
+    def test_isoformat_time_ns(self):
+        import random
+
+        rand = random.Random(0)
+        testcases = [
+            1649694687000000000,
+            1649694687000000999,
+            1649694687999999500,
+            1649694687999999999,
+            1649694687000000500,
+            1649694687000001500,
+        ]
+        testcases += [rand.randrange(10**18, 2 * 10**18) for _ in range(10000)]
+        for ns in testcases:
+            self.assertEqual(
+                isoformat_time_ns(ns), isoformat_time_ns_reference(ns), f"ns={ns}"
+            )
+
+    def test_buffered_output(self):
+        msgs = [
+            wagglemsg.Message("test", 1, 1649694687904754000, {}),
+            wagglemsg.Message("test.with.meta", 2.5, 1649694687904755000, {"k": "v"}),
+            wagglemsg.Message("test.str", "three", 1649694687000000000, {}),
+        ]
+        with TemporaryDirectory() as dir:
+            pub = FilesystemPublisher(dir, flush_interval=3600)
+            for msg in msgs:
+                pub.publish(msg)
+            datafile = Path(dir, "data.ndjson")
+            self.assertEqual(datafile.read_text(), "")
+            pub.close()
+
+            expect = ""
+            for msg in msgs:
+                out = {
+                    "name": msg.name,
+                    "value": msg.value,
+                    "meta": msg.meta,
+                    "timestamp": isoformat_time_ns_reference(msg.timestamp),
+                }
+                expect += json.dumps(out, sort_keys=True, separators=(",", ":")) + "\n"
+            self.assertEqual(datafile.read_text(), expect)
+
+    def test_flush_size(self):
+        with TemporaryDirectory() as dir:
+            pub = FilesystemPublisher(dir, flush_size=1, flush_interval=3600)
+            pub.publish(wagglemsg.Message("test", 1, 1649694687904754000, {}))
+            self.assertNotEqual(Path(dir, "data.ndjson").read_text(), "")
+            pub.close()
+
+
 class TestPluginLogDir(unittest.TestCase):
     def test_log_dir(self):
         import sage_data_client